@@ -0,0 +1,203 @@
+import time
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+
+from topk import top_n_indices
+
+
+class IvfIndex:
+    """
+    Inverted file (IVF) index for approximate cosine nearest-neighbour search.
+
+    The rows of a normalized feature matrix are clustered with spherical k-means
+    into `n_lists` inverted lists. A query is only compared against the rows of the
+    `n_probe` lists whose centroids are most similar to it, which trades recall for
+    latency: more probes = higher recall and slower queries.
+    """
+
+    def __init__(
+            self,
+            centroids: np.ndarray,
+            list_offsets: np.ndarray,
+            list_rows: np.ndarray,
+            n_probe: int = 8,
+            fingerprint: Optional[str] = None,
+    ):
+        self.centroids = centroids
+        self.list_offsets = list_offsets
+        self.list_rows = list_rows
+        self.n_probe = n_probe
+        # Fingerprint of the dataset the index was built from (see `LocalDataset.fingerprint`)
+        self.fingerprint = fingerprint
+
+    @property
+    def n_lists(self) -> int:
+        return len(self.centroids)
+
+    @property
+    def n_rows(self) -> int:
+        return len(self.list_rows)
+
+    @classmethod
+    def build(
+            cls,
+            features: np.ndarray,
+            n_lists: Optional[int] = None,
+            n_probe: int = 8,
+            n_iter: int = 20,
+            sample_size: int = 50_000,
+            seed: int = 42,
+    ) -> "IvfIndex":
+        """
+        :param features: L2-normalized feature matrix (see `LocalDataset.matrix`).
+        :param n_lists: Number of inverted lists, defaults to 4 * sqrt(#rows).
+        :param sample_size: Number of rows the k-means centroids are trained on.
+        """
+        n_rows = features.shape[0]
+        if n_lists is None:
+            n_lists = int(4 * np.sqrt(n_rows))
+        n_lists = max(1, min(n_lists, n_rows))
+
+        rng = np.random.default_rng(seed)
+        sample = features[np.sort(rng.choice(n_rows, size=min(n_rows, sample_size), replace=False))]
+        centroids = sample[rng.choice(len(sample), size=n_lists, replace=False)].copy()
+
+        for _ in range(n_iter):
+            assignment = np.argmax(sample @ centroids.T, axis=1)
+
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignment, sample)
+
+            # Empty lists keep their previous centroid
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            non_empty = norms[:, 0] > 0.0
+            centroids[non_empty] = sums[non_empty] / norms[non_empty]
+
+        assignment = np.concatenate([
+            np.argmax(features[start:start + 8192] @ centroids.T, axis=1)
+            for start in range(0, n_rows, 8192)
+        ])
+
+        list_rows = np.argsort(assignment, kind="stable").astype(np.int32)
+        list_offsets = np.zeros(n_lists + 1, dtype=np.int64)
+        np.cumsum(np.bincount(assignment, minlength=n_lists), out=list_offsets[1:])
+
+        return cls(centroids.astype(np.float32), list_offsets, list_rows, n_probe)
+
+    def search(
+            self,
+            features: np.ndarray,
+            query: np.ndarray,
+            k: int,
+            n_probe: Optional[int] = None,
+            exclude_row: Optional[int] = None,
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """
+        :param features: The normalized feature matrix the index was built on.
+        :param query: Normalized query vector.
+        :return: Rows and similarities of the (approximate) top-k neighbours.
+        """
+        n_probe = min(n_probe or self.n_probe, self.n_lists)
+
+        probed_lists = np.argsort(self.centroids @ query)[::-1][:n_probe]
+        candidates = np.concatenate([
+            self.list_rows[self.list_offsets[i]:self.list_offsets[i + 1]] for i in probed_lists
+        ])
+
+        similarities = features[candidates] @ query
+        if exclude_row is not None:
+            similarities[candidates == exclude_row] = -np.inf
+
+        k = min(k, len(candidates))
+        top = np.argpartition(similarities, -k)[-k:]
+        top = top[np.argsort(similarities[top])[::-1]]
+        top = top[np.isfinite(similarities[top])]
+        return candidates[top], similarities[top]
+
+    def save(self, path: Path) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        np.savez(
+            path,
+            centroids=self.centroids,
+            list_offsets=self.list_offsets,
+            list_rows=self.list_rows,
+            n_probe=self.n_probe,
+            fingerprint=np.array(self.fingerprint or ""),
+        )
+
+    @classmethod
+    def load(cls, path: Path) -> "IvfIndex":
+        with np.load(path) as data:
+            # Indexes saved without a fingerprint never match a dataset
+            fingerprint = str(data["fingerprint"]) if "fingerprint" in data.files else ""
+            return cls(
+                data["centroids"], data["list_offsets"], data["list_rows"], int(data["n_probe"]), fingerprint or None
+            )
+
+    @classmethod
+    def load_or_build(cls, dataset, n_lists: Optional[int] = None, n_probe: int = 8, **build_kwargs) -> "IvfIndex":
+        """Loads the index of `dataset` from 'ann_indexes/' or builds and saves it on-the-fly."""
+        features = dataset.matrix
+        if n_lists is None:
+            n_lists = int(4 * np.sqrt(len(features)))
+
+        path = Path("ann_indexes") / f"{dataset.name}_ivf{n_lists}.npz"
+        if path.exists():
+            index = cls.load(path)
+            # The fingerprint changes with the features even if their shape does not
+            if index.fingerprint == dataset.fingerprint:
+                index.n_probe = n_probe
+                return index
+            print(f"  --> ANN index '{path}' does not match dataset '{dataset.name}', rebuilding it")
+
+        print(f"  --> Building IVF index with {n_lists} lists for '{dataset.name}' and saving it to '{path}'")
+        index = cls.build(features, n_lists=n_lists, n_probe=n_probe, **build_kwargs)
+        index.fingerprint = dataset.fingerprint
+        index.save(path)
+        return index
+
+
+def ann_recall_report(
+        dataset,
+        index: IvfIndex,
+        k: int = 10,
+        n_probes: tuple[int, ...] = (1, 2, 4, 8, 16, 32),
+        n_queries: int = 500,
+        seed: int = 42,
+) -> pd.DataFrame:
+    """
+    Measures recall@k and per-query latency of `index` against the exact search
+    for a sample of queries, once for every `n_probe` setting.
+    """
+    features = dataset.matrix
+    rng = np.random.default_rng(seed)
+    query_rows = rng.choice(len(features), size=min(n_queries, len(features)), replace=False)
+
+    exact = {}
+    start_time = time.perf_counter()
+    for row in query_rows:
+        similarities = features @ features[row]
+        similarities[row] = -np.inf
+        exact[row] = set(top_n_indices(similarities, k).tolist())
+    exact_ms = (time.perf_counter() - start_time) * 1000 / len(query_rows)
+
+    report = []
+    for n_probe in n_probes:
+        hits = 0
+        start_time = time.perf_counter()
+        for row in query_rows:
+            rows, _ = index.search(features, features[row], k, n_probe=n_probe, exclude_row=row)
+            hits += len(exact[row].intersection(rows.tolist()))
+        ann_ms = (time.perf_counter() - start_time) * 1000 / len(query_rows)
+
+        report.append({
+            "n_probe": n_probe,
+            f"recall@{k}": hits / (len(query_rows) * k),
+            "ann_ms_per_query": ann_ms,
+            "exact_ms_per_query": exact_ms,
+        })
+
+    return pd.DataFrame(report)
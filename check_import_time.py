@@ -0,0 +1,59 @@
+"""
+Checks that importing the retrieval API stays cheap: every module is imported in a
+fresh interpreter, which must take less than the budget and must not pull in any of
+the heavy libraries that are only needed for plotting, notebooks or PCA.
+
+    python check_import_time.py [--budget SECONDS] [module ...]
+"""
+import argparse
+import json
+import subprocess
+import sys
+from pathlib import Path
+
+DEFAULT_MODULES = ["retrieval", "retrieval_systems", "retrieval_cache", "song", "datasets"]
+DEFAULT_BUDGET = 1.0
+
+# Imported lazily, where they are actually needed
+HEAVY_MODULES = ["matplotlib", "sklearn", "scipy", "IPython", "ipywidgets", "tqdm"]
+
+_PROBE = """
+import importlib, json, sys, time
+start = time.perf_counter()
+importlib.import_module(sys.argv[1])
+elapsed = time.perf_counter() - start
+print(json.dumps({"seconds": elapsed, "heavy": [m for m in json.loads(sys.argv[2]) if m in sys.modules]}))
+"""
+
+
+def import_time(module: str, repeats: int = 3) -> tuple[float, list[str]]:
+    """Best-of-`repeats` time (in seconds) to import `module` in a fresh interpreter, and the heavy modules it loaded."""
+    best, heavy = float("inf"), []
+    for _ in range(repeats):
+        output = subprocess.run(
+            [sys.executable, "-c", _PROBE, module, json.dumps(HEAVY_MODULES)],
+            check=True, capture_output=True, text=True, cwd=Path(__file__).parent,
+        ).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        best, heavy = min(best, result["seconds"]), result["heavy"]
+    return best, heavy
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("modules", nargs="*", default=DEFAULT_MODULES)
+    parser.add_argument("--budget", type=float, default=DEFAULT_BUDGET, help="Seconds per module")
+    args = parser.parse_args()
+
+    failed = False
+    for module in args.modules:
+        seconds, heavy = import_time(module)
+        ok = seconds <= args.budget and not heavy
+        failed |= not ok
+        print(f"{'OK  ' if ok else 'FAIL'} {module}: {seconds:.3f}s" + (f", imports {', '.join(heavy)}" if heavy else ""))
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
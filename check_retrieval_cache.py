@@ -0,0 +1,83 @@
+"""
+Checks that `TopKStore.get_block` serves every store layout at any depth: queries
+without n stored neighbours must come back as rows of -1 (and NaN scores) instead of
+raising, whether the store is empty, its snapshot is shallower than n, or it is not
+persistent (and so never compacted).
+
+    python check_retrieval_cache.py
+"""
+import sys
+import tempfile
+import traceback
+from pathlib import Path
+
+import numpy as np
+
+from retrieval_cache import TopKStore
+
+IDS = ["a", "b", "c"]
+
+
+def _put(store: TopKStore, depth: int) -> None:
+    rows = store.rows_for(IDS)
+    neighbours = np.tile(np.arange(depth, dtype=np.int32) % len(IDS), (len(IDS), 1))
+    scores = np.linspace(1.0, 0.0, depth, dtype=np.float32)[None, :].repeat(len(IDS), axis=0)
+    store.put(rows, neighbours, scores)
+
+
+def _assert_missing(store: TopKStore, song_ids: list[str], n: int) -> None:
+    neighbours, scores = store.get_block(song_ids, n)
+    assert neighbours.shape == scores.shape == (len(song_ids), n), neighbours.shape
+    assert (neighbours == -1).all() and np.isnan(scores).all()
+
+
+def check_empty_store(directory: Path) -> None:
+    store = TopKStore(directory / "empty")
+    _assert_missing(store, ["a", "unknown"], 100)
+    _assert_missing(store, [], 100)
+
+
+def check_shallower_snapshot(directory: Path) -> None:
+    store = TopKStore(directory / "shallow")
+    _put(store, 10)
+    store.flush()
+    store.compact()
+
+    store = TopKStore(directory / "shallow")
+    _assert_missing(store, IDS + ["unknown"], 100)
+
+    neighbours, scores = store.get_block(["a", "unknown"], 5)
+    assert neighbours[0].tolist() == [0, 1, 2, 0, 1] and (neighbours[1] == -1).all()
+    assert not np.isnan(scores[0]).any() and np.isnan(scores[1]).all()
+
+
+def check_non_persistent_store(directory: Path) -> None:
+    store = TopKStore(directory / "memory", persistent=False)
+    _assert_missing(store, IDS, 100)
+
+    _put(store, 10)
+    store.compact()
+    _assert_missing(store, IDS, 100)
+    assert (store.get_block(IDS, 10)[0] >= 0).all()
+
+
+CHECKS = [check_empty_store, check_shallower_snapshot, check_non_persistent_store]
+
+
+def main() -> int:
+    failed = False
+    with tempfile.TemporaryDirectory() as directory:
+        for check in CHECKS:
+            try:
+                check(Path(directory))
+                print(f"OK   {check.__name__}")
+            except Exception:
+                failed = True
+                print(f"FAIL {check.__name__}")
+                traceback.print_exc()
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
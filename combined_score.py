@@ -1,12 +1,9 @@
 import matplotlib.pyplot as plt
-from tqdm.notebook import tqdm
 from dataclasses import dataclass
-from genre_coverage import GenreCoverage
-from genre_diversity import GenreDiversity
 
+from eval_runner import EvaluationRunner
+from evaluation import Evaluation, GenreCoverageMetric, GenreDiversityMetric, NdcgMetric, PrecisionRecallMetric
 from genres import Genres
-from ndcg import Ndcg
-from precision_recall import PrecisionRecall
 from retrieval import Retrieval, RETRIEVAL_SYSTEMS
 from utils import plot_ret_sys_dict
 
@@ -30,31 +27,25 @@ class CombinedScore:
         self._genres = genres
         self._ret = Retrieval(n=self._n)
 
-    def compute(self) -> None:
-        # no pickles needed here since all other results are pickled already
-
-        pr = PrecisionRecall(self._genres, self._ret)
-        pr.compute()
-        precision_recall_result = pr.get_retrieval_results()
-
-        ndcg = Ndcg(self._genres, self._ret)
-        ndcg.compute()
-        ndcg_result = ndcg.get_retrieval_results()
-
-        gc = GenreCoverage(self._genres, self._ret)
-        gc.compute()
-        genre_coverage_result = gc.get_retrieval_results()
-
-        gd = GenreDiversity(self._genres, self._ret)
-        gd.compute()
-        genre_diversity_result = gd.get_retrieval_results()
-
-        for ret_sys_name, ret_sys in RETRIEVAL_SYSTEMS.items():
-            precision = precision_recall_result[ret_sys_name].precision_at_k[10]
-            recall = precision_recall_result[ret_sys_name].recall_at_k[10]
-            ndcg = ndcg_result[ret_sys_name]
-            genre_coverage = genre_coverage_result[ret_sys_name]
-            genre_diversity = genre_diversity_result[ret_sys_name]
+    def compute(self, processes: int = 1) -> None:
+        # All metrics are computed in a single pass over the top-k lists of every system
+        evaluation = Evaluation(
+            self._genres,
+            [PrecisionRecallMetric(10), NdcgMetric(10), GenreCoverageMetric(10), GenreDiversityMetric(10)],
+            self._ret,
+        )
+        if processes > 1:
+            evaluation_results = EvaluationRunner(evaluation, processes).run("combined_score_at_10", list(RETRIEVAL_SYSTEMS))
+        else:
+            evaluation_results = evaluation.run(list(RETRIEVAL_SYSTEMS), cache_name="combined_score_at_10")
+
+        for ret_sys_name, results in evaluation_results.items():
+            precision_at_k, recall_at_k = results["precision_recall"]
+            precision = precision_at_k[10]
+            recall = recall_at_k[10]
+            ndcg = results["ndcg"]
+            genre_coverage = results["genre_coverage"]
+            genre_diversity = results["genre_diversity"]
             f1_score = self.f1_score(precision, recall)
 
             self._results[ret_sys_name] = CombinedEvalResult(
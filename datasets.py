@@ -1,45 +1,459 @@
 import os
+import json
+import hashlib
+import threading
+import numpy as np
 import pandas as pd
+from collections import OrderedDict
+from pathlib import Path
 from typing import Optional
 
+from lazy import Lazy
 from utils import read_tsv
 
 
+def normalize_rows(features: np.ndarray) -> np.ndarray:
+    features = np.ascontiguousarray(features, dtype=np.float32)
+    norms = np.linalg.norm(features, axis=1, keepdims=True)
+    norms[norms == 0.0] = 1.0
+    return features / norms
+
+
+def compute_fingerprint(ids: np.ndarray, matrix: np.ndarray, build_params: dict) -> str:
+    h = hashlib.blake2b(digest_size=16)
+    h.update(json.dumps(build_params, sort_keys=True).encode("utf-8"))
+    h.update("\n".join(ids.tolist()).encode("utf-8"))
+    h.update(np.ascontiguousarray(matrix).tobytes())
+    return h.hexdigest()
+
+
+def _file_sha256(path: Path) -> str:
+    h = hashlib.sha256()
+    with path.open("rb") as fp:
+        for chunk in iter(lambda: fp.read(1024 ** 2), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _save_npy_atomic(path: Path, array: np.ndarray) -> None:
+    tmp_path = path.with_name(path.name + ".tmp")
+    with tmp_path.open("wb") as fp:
+        np.save(fp, array)
+    os.replace(tmp_path, path)
+
+
+class DatasetSnapshot:
+    """
+    Binary snapshot of a TSV dataset in 'datasets/snapshots/<name>/', consisting of
+    the raw float32 features, the L2-normalized float32 matrix, the id array and
+    'meta.json' with the column names, fingerprint and the size/mtime/hash of the
+    TSV file it was converted from. The arrays are memory-mapped, so loading is
+    near-instant and the pages are shared between processes.
+
+    Tables that are not purely numeric (e.g. 'information') only get a 'meta.json'
+    that marks them as such, and keep being read from their TSV file.
+    """
+
+    def __init__(self, directory: Path, meta: dict):
+        self.directory = directory
+        self.meta = meta
+
+    @property
+    def is_numeric(self) -> bool:
+        return self.meta["numeric"]
+
+    @property
+    def columns(self) -> list[str]:
+        return self.meta["columns"]
+
+    @property
+    def fingerprint(self) -> str:
+        return self.meta["fingerprint"]
+
+    @property
+    def ids(self) -> np.ndarray:
+        return np.load(self.directory / "ids.npy", mmap_mode="r")
+
+    @property
+    def features(self) -> np.ndarray:
+        return np.load(self.directory / "features.npy", mmap_mode="r")
+
+    @property
+    def matrix(self) -> np.ndarray:
+        return np.load(self.directory / "matrix.npy", mmap_mode="r")
+
+    @staticmethod
+    def directory_for(name: str) -> Path:
+        return Path("datasets") / "snapshots" / name
+
+    @classmethod
+    def open(cls, name: str, tsv_path: Path) -> Optional["DatasetSnapshot"]:
+        """
+        Returns the snapshot of `name` if it exists and matches `tsv_path`, None otherwise.
+        Without the TSV file (e.g. when only the snapshots were copied) it is trusted as is.
+        """
+        directory = cls.directory_for(name)
+        try:
+            with (directory / "meta.json").open() as fp:
+                meta = json.load(fp)
+        except FileNotFoundError:
+            return None
+
+        try:
+            stat = tsv_path.stat()
+        except FileNotFoundError:
+            return cls(directory, meta)
+        if meta["tsv_size"] != stat.st_size:
+            return None
+
+        if meta["tsv_mtime_ns"] != stat.st_mtime_ns:
+            # The file was touched (or copied), only its contents decide whether it changed
+            if meta["tsv_sha256"] != _file_sha256(tsv_path):
+                return None
+            meta["tsv_mtime_ns"] = stat.st_mtime_ns
+            cls._write_meta(directory, meta)
+
+        return cls(directory, meta)
+
+    @classmethod
+    def write(cls, dataset: "LocalDataset", tsv_path: Path) -> "DatasetSnapshot":
+        directory = cls.directory_for(dataset.name)
+        directory.mkdir(parents=True, exist_ok=True)
+
+        stat = tsv_path.stat()
+        columns = [c for c in dataset.df.columns if c != "id"]
+        numeric = all(pd.api.types.is_numeric_dtype(dataset.df[c]) for c in columns)
+
+        meta = {
+            "numeric": numeric,
+            "columns": columns,
+            "tsv_size": stat.st_size,
+            "tsv_mtime_ns": stat.st_mtime_ns,
+            "tsv_sha256": _file_sha256(tsv_path),
+            "fingerprint": None,
+        }
+
+        if numeric:
+            _save_npy_atomic(directory / "ids.npy", np.asarray(dataset.ids, dtype=str))
+            _save_npy_atomic(directory / "features.npy", dataset.df[columns].to_numpy(dtype=np.float32))
+            _save_npy_atomic(directory / "matrix.npy", dataset.matrix)
+            meta["fingerprint"] = dataset.fingerprint
+
+        # meta.json is written last since it marks the snapshot as complete
+        cls._write_meta(directory, meta)
+        return cls(directory, meta)
+
+    @staticmethod
+    def _write_meta(directory: Path, meta: dict) -> None:
+        tmp_path = directory / "meta.json.tmp"
+        with tmp_path.open("w") as fp:
+            json.dump(meta, fp)
+        os.replace(tmp_path, directory / "meta.json")
+
+
+def _require_datasets_directory() -> None:
+    # Checked when data is loaded rather than on import, so that e.g. cached results can be served without it
+    if not os.path.isdir("datasets"):
+        raise RuntimeError(
+            "'datasets' directory not present. "
+            "Create it in the project root folder and place your dataset files there."
+        )
+
+
 class LocalDataset:
-    def __init__(self, name: str, df: Optional[pd.DataFrame] = None):
+    def __init__(self, name: str, df: Optional[pd.DataFrame] = None, build_params: Optional[dict] = None):
         self.name = name
+        # Parameters this dataset was derived with (e.g. by EarlyFusion), part of its fingerprint
+        self.build_params = build_params or {}
+
+        # Set by `Datasets`, which may unload this dataset to stay within its memory budget
+        self.memory_manager: Optional["DatasetMemoryManager"] = None
+        # Only datasets that are loaded from disk can be unloaded and reloaded later on
+        self.is_reloadable = df is None
+
+        self._ids: Optional[np.ndarray] = None
+        self._id_to_row: Optional[dict[str, int]] = None
+        self._matrix: Optional[np.ndarray] = None
+        self._fingerprint: Optional[str] = None
+
+        # Optional approximate nearest-neighbour index (e.g. `ann.IvfIndex`) used by
+        # `Retrieval.top_similar_tracks` instead of the exhaustive search
+        self.ann_index = None
 
         if df is None:
             self._df = df
         else:
             self.set_df(df)
 
-        if not os.path.isdir("datasets"):
-            raise RuntimeError(
-                "'datasets' directory not present. "
-                "Create it in the project root folder and place your dataset files there."
-            )
+    @classmethod
+    def from_arrays(
+            cls,
+            name: str,
+            ids: np.ndarray,
+            features: np.ndarray,
+            columns: list[str],
+            matrix: Optional[np.ndarray] = None,
+            build_params: Optional[dict] = None,
+            fingerprint: Optional[str] = None,
+    ) -> "LocalDataset":
+        """
+        Dataset over (possibly memory-mapped) arrays, e.g. an `EarlyFusion` result.
+        The arrays are used without copying, so they must be filtered already.
+        """
+        dataset = cls(name, build_params=build_params)
+        dataset.is_reloadable = False
+
+        df = pd.DataFrame(features, columns=columns, copy=False)
+        df.insert(0, "id", ids)
+        dataset._df = df
+        dataset._ids = ids
+        dataset._matrix = matrix
+        dataset._fingerprint = fingerprint
+        return dataset
 
     def set_df(self, new_df: pd.DataFrame) -> None:
         self._df = new_df[new_df["id"] != "03Oc9WeMEmyLLQbj"]
 
+        # Derived lookup structures are rebuilt lazily for the new DataFrame
+        self._ids = None
+        self._id_to_row = None
+        self._matrix = None
+        self._fingerprint = None
+        self.ann_index = None
+
         if self._df.empty:
             print(f"WARN: DataFrame '{self.name}' is empty!")
 
+    @property
+    def tsv_path(self) -> Path:
+        return Path("datasets") / f"id_{self.name}_mmsr.tsv"
+
     @property
     def df(self) -> pd.DataFrame:
+        return self._ensure_loaded()
+
+    def _ensure_loaded(self) -> pd.DataFrame:
+        """Loads the dataset (and with a snapshot its ids, matrix and fingerprint) if it is not loaded yet."""
+        df = self._df
         # Lazy load dataset on .df access
+        if df is None:
+            self._load()
+            df = self._df
+            if self.memory_manager is not None:
+                self.memory_manager.loaded(self)
+        else:
+            self._touch()
+        return df
+
+    def _touch(self) -> None:
+        if self.memory_manager is not None:
+            self.memory_manager.touch(self)
+
+    @property
+    def is_loaded(self) -> bool:
+        return self._df is not None
+
+    @property
+    def resident_bytes(self) -> int:
+        """Memory taken up by the loaded DataFrame and feature matrix (memory-mapped pages included)."""
+        df, matrix = self._df, self._matrix
+        size = int(df.memory_usage(index=True, deep=False).sum()) if df is not None else 0
+        if matrix is not None:
+            size += matrix.nbytes
+        return size
+
+    def unload(self) -> None:
+        """Frees the loaded data; it is lazily reloaded (from its snapshot) on the next access."""
+        if not self.is_reloadable:
+            raise RuntimeError(f"Dataset '{self.name}' was not loaded from disk and cannot be unloaded")
+
+        self._df = None
+        self._ids = None
+        self._id_to_row = None
+        self._matrix = None
+
+    def _load(self) -> None:
+        _require_datasets_directory()
+        snapshot = DatasetSnapshot.open(self.name, self.tsv_path)
+
+        if snapshot is not None and snapshot.is_numeric:
+            # The DataFrame is a view onto the memory-mapped features. Snapshots are
+            # filtered already, and set_df's filtering would copy the features.
+            df = pd.DataFrame(snapshot.features, columns=snapshot.columns, copy=False)
+            df.insert(0, "id", snapshot.ids)
+            self._df = df
+
+            self._id_to_row = None
+            self.ann_index = None
+            self._ids = snapshot.ids
+            self._matrix = snapshot.matrix
+            self._fingerprint = snapshot.fingerprint
+            return
+
+        self.set_df(read_tsv(str(self.tsv_path)))
+        if snapshot is None:
+            print(f"Converting '{self.tsv_path}' into a binary snapshot for faster loading")
+            DatasetSnapshot.write(self, self.tsv_path)
+
+    def build_snapshot(self) -> None:
+        """Converts the TSV file of this dataset into a binary snapshot (if not up to date already)."""
+        _require_datasets_directory()
+        if DatasetSnapshot.open(self.name, self.tsv_path) is None:
+            if self._df is None:
+                self.set_df(read_tsv(str(self.tsv_path)))
+            DatasetSnapshot.write(self, self.tsv_path)
+
+    @property
+    def shape(self) -> tuple[int, int]:
+        """(#songs, #feature columns), read from the snapshot instead of loading the data if possible."""
         if self._df is None:
-            new_df = read_tsv(f"datasets/id_{self.name}_mmsr.tsv")
-            self.set_df(new_df)
-        return self._df
+            snapshot = DatasetSnapshot.open(self.name, self.tsv_path)
+            if snapshot is not None and snapshot.is_numeric:
+                return len(snapshot.ids), len(snapshot.columns)
+        return self.df.shape[0], self.df.shape[1] - 1
+
+    @property
+    def ids(self) -> np.ndarray:
+        """Song ids in row order of :attr:`matrix`."""
+        ids = self._ids
+        if ids is None:
+            df = self._ensure_loaded()
+            ids = self._ids
+            if ids is None:
+                ids = self._ids = df["id"].values
+        else:
+            self._touch()
+        return ids
+
+    @property
+    def id_to_row(self) -> dict[str, int]:
+        if self._id_to_row is None:
+            self._id_to_row = {song_id: row for row, song_id in enumerate(self.ids)}
+        return self._id_to_row
+
+    def row_of(self, song_id: str) -> int:
+        row = self.id_to_row.get(song_id)
+        if row is None:
+            raise ValueError(f"Track ID {song_id} not found in the data.")
+        return row
+
+    @property
+    def matrix(self) -> np.ndarray:
+        """
+        Contiguous float32 feature matrix with L2-normalized rows, so that the
+        cosine similarity of two songs is the dot product of their rows.
+        Rows with a zero norm are left as zeros (similarity 0 to everything).
+        """
+        matrix = self._matrix
+        if matrix is None:
+            df = self._ensure_loaded()
+            matrix = self._matrix
+            if matrix is None:
+                features = df.loc[:, df.columns != "id"].to_numpy(dtype=np.float32)
+                matrix = self._matrix = normalize_rows(features)
+                if self.memory_manager is not None:
+                    self.memory_manager.loaded(self)
+        else:
+            self._touch()
+        return matrix
+
+    @property
+    def fingerprint(self) -> str:
+        """Content hash of the song ids, the feature matrix and the build parameters."""
+        if self._fingerprint is None and self._df is None and self.is_reloadable:
+            # Read from the snapshot's meta.json, without loading the data
+            snapshot = DatasetSnapshot.open(self.name, self.tsv_path)
+            if snapshot is not None and snapshot.is_numeric:
+                return snapshot.fingerprint
+        if self._fingerprint is None:
+            # Loading a snapshot already provides the fingerprint
+            self._ensure_loaded()
+            if self._fingerprint is None:
+                self._fingerprint = compute_fingerprint(self.ids, self.matrix, self.build_params)
+        return self._fingerprint
 
     def __str__(self):
         return self.name
 
 
+class DatasetMemoryManager:
+    """
+    Keeps the loaded datasets within a memory budget (in bytes) by unloading the
+    least recently used ones. Unloaded datasets are reloaded lazily on their next
+    access, which is cheap if they have a binary snapshot. Datasets that cannot be
+    reloaded (e.g. computed ones) are never evicted but count towards the usage.
+    """
+
+    def __init__(self, budget: Optional[int] = None):
+        self.budget = budget
+
+        # Loaded datasets, least recently used first
+        self._loaded: OrderedDict[int, LocalDataset] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def touch(self, dataset: LocalDataset) -> None:
+        with self._lock:
+            if id(dataset) in self._loaded:
+                self._loaded.move_to_end(id(dataset))
+
+    def loaded(self, dataset: LocalDataset) -> None:
+        with self._lock:
+            self._loaded[id(dataset)] = dataset
+            self._loaded.move_to_end(id(dataset))
+            self._enforce_budget(keep=dataset)
+
+    def set_budget(self, budget: Optional[int]) -> None:
+        with self._lock:
+            self.budget = budget
+            self._enforce_budget()
+
+    def usage(self) -> dict[str, int]:
+        """Resident bytes of every loaded dataset, least recently used first."""
+        with self._lock:
+            return {d.name: d.resident_bytes for d in self._loaded.values() if d.is_loaded}
+
+    def total_usage(self) -> int:
+        return sum(self.usage().values())
+
+    def _enforce_budget(self, keep: Optional[LocalDataset] = None) -> None:
+        # Forget datasets that have been unloaded or replaced in the meantime
+        for key in [key for key, d in self._loaded.items() if not d.is_loaded]:
+            del self._loaded[key]
+
+        if self.budget is None:
+            return
+
+        total = sum(d.resident_bytes for d in self._loaded.values())
+        for key, dataset in list(self._loaded.items()):
+            if total <= self.budget:
+                break
+            if dataset is keep or not dataset.is_reloadable:
+                continue
+
+            total -= dataset.resident_bytes
+            dataset.unload()
+            del self._loaded[key]
+
+
+def _memory_budget_from_env() -> Optional[int]:
+    """Parses e.g. MMSR_DATASET_MEMORY_BUDGET=4G (suffixes K, M and G are supported)."""
+    value = os.environ.get("MMSR_DATASET_MEMORY_BUDGET")
+    if not value:
+        return None
+
+    units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+    value = value.strip().upper().rstrip("B")
+    if value[-1:] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
+
+
 class Datasets:
-    def __init__(self):
+    def __init__(self, memory_budget: Optional[int] = None):
+        self.memory_manager = DatasetMemoryManager(
+            memory_budget if memory_budget is not None else _memory_budget_from_env()
+        )
+
         self.blf_correlation = LocalDataset("blf_correlation")
         self.blf_deltaspectral = LocalDataset("blf_deltaspectral")
         self.blf_logfluc = LocalDataset("blf_logfluc")
@@ -64,9 +478,29 @@ class Datasets:
         self.musicnn = LocalDataset("musicnn")
         self.resnet = LocalDataset("resnet")
 
+    def __setattr__(self, name, value):
+        # Datasets attached later on (e.g. early fusion results) are managed as well
+        if isinstance(value, LocalDataset):
+            value.memory_manager = self.memory_manager
+        super().__setattr__(name, value)
+
     @property
     def vgg19(self) -> LocalDataset:
         return self.vgg
 
+    def set_memory_budget(self, budget: Optional[int]) -> None:
+        """Sets the memory budget in bytes (None = unlimited), unloading datasets if necessary."""
+        self.memory_manager.set_budget(budget)
+
+    def memory_usage(self) -> dict[str, int]:
+        """Resident bytes of every currently loaded dataset."""
+        return self.memory_manager.usage()
+
+    def build_snapshots(self) -> None:
+        """One-time conversion of all TSV datasets into binary snapshots."""
+        for dataset in {id(d): d for d in vars(self).values() if isinstance(d, LocalDataset)}.values():
+            if dataset.tsv_path.exists():
+                dataset.build_snapshot()
+
 
-datasets = Datasets()
+datasets: Datasets = Lazy(Datasets)
@@ -1,42 +1,267 @@
+import hashlib
+import json
+from pathlib import Path
+from typing import Literal, Optional
+
+import numpy as np
 import pandas as pd
-from sklearn.decomposition import PCA
-from datasets import LocalDataset
+
+from datasets import DatasetSnapshot, LocalDataset, normalize_rows, _save_npy_atomic
+
+PcaMethod = Literal["auto", "full", "randomized", "incremental"]
+
+# Above this size (of the float64 features) "auto" fits the PCA incrementally in chunks
+DEFAULT_PCA_MEMORY_BUDGET = 1024 ** 3
 
 
 class EarlyFusion:
-    def __init__(self, d1: LocalDataset, d2: LocalDataset, n_components: float):
+    """
+    Concatenates the PCA projections of two datasets (inner join on the song id, in the
+    row order of `d1`).
+
+    The fitted projections and the fused float32 matrix are stored in
+    'pickled_state/early_fusion/<key>/', keyed by the fingerprints of both inputs, the
+    number of components and the PCA method, and are memory-mapped when loaded again.
+
+    :param n_components: Number of components per dataset, or a fraction (<= 1.0) of
+        the smaller one's number of columns.
+    :param method: "full" (exact SVD), "randomized" (randomized SVD), "incremental"
+        (`IncrementalPCA` fitted chunk by chunk from the memory-mapped dataset snapshot, so
+        the features are never loaded into memory as a whole) or "auto" (incremental for
+        large datasets, else sklearn's choice).
+    :param batch_size: Number of songs per chunk of the incremental PCA and of the
+        projection; at least `n_components`.
+    """
+
+    def __init__(
+            self,
+            d1: LocalDataset,
+            d2: LocalDataset,
+            n_components: float,
+            method: PcaMethod = "auto",
+            batch_size: int = 10_000,
+            random_state: int = 42,
+    ):
         self.d1 = d1
         self.d2 = d2
 
+        self.n_components = n_components = self.resolve_n_components(d1, d2, n_components)
+        if method in ("incremental", "auto") and batch_size < n_components:
+            raise ValueError(f"batch_size ({batch_size}) must be at least n_components ({n_components})")
+        self.method = method
+        self.batch_size = batch_size
+        self.random_state = random_state
+
+        self.directory = self.directory_for(d1, d2, n_components, self.build_params)
+        if (self.directory / "meta.json").exists():
+            print(f"  --> Loading early fusion of '{d1.name}' and '{d2.name}' from '{self.directory}'")
+        else:
+            print(f"[Early Fusion] Down-projecting '{d1.name}' and '{d2.name}' with PCA to {n_components} components")
+            self._early_fusion()
+
+        with (self.directory / "meta.json").open() as fp:
+            self.meta = json.load(fp)
+
+        self._df: Optional[pd.DataFrame] = None
+
+    @staticmethod
+    def resolve_n_components(d1: LocalDataset, d2: LocalDataset, n_components: float) -> int:
         if n_components <= 1.0:
-            n_components = int(min(len(d1.df.columns), len(d2.df.columns)) * n_components)
+            # The "+ 1" accounts for the id column, which has always been part of the count
+            n_components = int((min(d1.shape[1], d2.shape[1]) + 1) * n_components)
+        return int(n_components)
+
+    @staticmethod
+    def _build_params(
+            d1: LocalDataset,
+            d2: LocalDataset,
+            n_components: int,
+            method: PcaMethod,
+            random_state: int,
+    ) -> dict:
+        return {
+            "early_fusion": [d1.fingerprint, d2.fingerprint],
+            "n_components": n_components,
+            "method": method,
+            "random_state": random_state,
+        }
+
+    @staticmethod
+    def directory_for(d1: LocalDataset, d2: LocalDataset, n_components: int, build_params: dict) -> Path:
+        h = hashlib.blake2b(json.dumps(build_params, sort_keys=True).encode("utf-8"), digest_size=16)
+        return Path("pickled_state") / "early_fusion" / f"{d1.name}_{d2.name}_{n_components}_{h.hexdigest()}"
+
+    @classmethod
+    def persisted_fingerprint(
+            cls,
+            d1: LocalDataset,
+            d2: LocalDataset,
+            n_components: float,
+            method: PcaMethod = "auto",
+            random_state: int = 42,
+    ) -> Optional[str]:
+        """
+        Fingerprint of the fused dataset with these parameters, read from its 'meta.json'
+        without loading or computing it; None if it has not been computed yet.
+        """
+        n_components = cls.resolve_n_components(d1, d2, n_components)
+        build_params = cls._build_params(d1, d2, n_components, method, random_state)
+        try:
+            with (cls.directory_for(d1, d2, n_components, build_params) / "meta.json").open() as fp:
+                return json.load(fp)["fingerprint"]
+        except FileNotFoundError:
+            return None
+
+    @property
+    def build_params(self) -> dict:
+        return self._build_params(self.d1, self.d2, self.n_components, self.method, self.random_state)
+
+    @property
+    def key(self) -> str:
+        return self.directory_for(self.d1, self.d2, self.n_components, self.build_params).name
 
-        self.n_components = n_components
+    @property
+    def columns(self) -> list[str]:
+        return self.meta["columns"]
 
-        print(f"[Early Fusion] Down-projecting '{d1.name}' and '{d2.name}' with PCA to {n_components} components")
-        self.df = self._early_fusion()
+    @property
+    def ids(self) -> np.ndarray:
+        return np.load(self.directory / "ids.npy", mmap_mode="r")
 
-    def get_pca_df(self, dataset: LocalDataset) -> pd.DataFrame:
-        pca = PCA(n_components=self.n_components)
+    @property
+    def features(self) -> np.ndarray:
+        """Fused float32 features (concatenated PCA projections)."""
+        return np.load(self.directory / "features.npy", mmap_mode="r")
 
-        features = dataset.df.drop("id", axis=1)
-        new_df = pd.DataFrame(
-            data=pca.fit_transform(features),
-            columns=[f"{dataset.name}_{i+1}" for i in range(self.n_components)]
+    @property
+    def matrix(self) -> np.ndarray:
+        """L2-normalized `features` (see `LocalDataset.matrix`)."""
+        return np.load(self.directory / "matrix.npy", mmap_mode="r")
+
+    @property
+    def df(self) -> pd.DataFrame:
+        if self._df is None:
+            df = pd.DataFrame(self.features, columns=self.columns, copy=False)
+            df.insert(0, "id", self.ids)
+            self._df = df
+        return self._df
+
+    def projection(self, dataset: LocalDataset) -> tuple[np.ndarray, np.ndarray]:
+        """Mean and components of the fitted PCA of `d1` or `d2`; the projection of x is (x - mean) @ components.T"""
+        with np.load(self.directory / f"pca_{self._input_index(dataset)}.npz") as data:
+            return data["mean"], data["components"]
+
+    def transform(self, dataset: LocalDataset, features: np.ndarray) -> np.ndarray:
+        """Projects raw `features` of `d1` or `d2` (e.g. of new songs) with the fitted PCA."""
+        mean, components = self.projection(dataset)
+        return ((np.asarray(features, dtype=np.float32) - mean) @ components.T).astype(np.float32)
+
+    def to_dataset(self, name: str) -> LocalDataset:
+        """The fused features as a dataset, without copying the memory-mapped arrays."""
+        return LocalDataset.from_arrays(
+            name,
+            ids=self.ids,
+            features=self.features,
+            columns=self.columns,
+            matrix=self.matrix,
+            build_params=self.build_params,
+            fingerprint=self.meta["fingerprint"],
         )
 
-        # We need to reset the index, otherwise insertion statement won't work
-        new_df.index = dataset.df.index
-        new_df.insert(0, "id", dataset.df["id"])
+    def _input_index(self, dataset: LocalDataset) -> int:
+        if dataset is self.d1:
+            return 1
+        if dataset is self.d2:
+            return 2
+        raise ValueError(f"Dataset '{dataset.name}' is not an input of this early fusion")
+
+    @staticmethod
+    def _source(dataset: LocalDataset) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Ids and raw features of `dataset`, memory-mapped from its snapshot (if it is
+        loaded from disk and unchanged), so that chunks of them can be read one at a time.
+        """
+        if dataset.is_reloadable:
+            dataset.build_snapshot()
+            snapshot = DatasetSnapshot.open(dataset.name, dataset.tsv_path)
+            if snapshot is not None and snapshot.is_numeric and snapshot.fingerprint == dataset.fingerprint:
+                return snapshot.ids, snapshot.features
+
+        df = dataset.df
+        return dataset.ids, df.loc[:, df.columns != "id"].to_numpy()
+
+    def _resolve_method(self, features: np.ndarray) -> PcaMethod:
+        if self.method != "auto":
+            return self.method
+        return "incremental" if features.shape[0] * features.shape[1] * 8 > DEFAULT_PCA_MEMORY_BUDGET else "auto"
+
+    def _fit_pca(self, features: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Fits the PCA of the (possibly memory-mapped) `features` and returns its mean,
+        components and float32 projection.
+        """
+        # sklearn takes about a second to import, and is not needed to load persisted results
+        from sklearn.decomposition import PCA, IncrementalPCA
+
+        method = self._resolve_method(features)
+
+        if method == "incremental":
+            pca = IncrementalPCA(n_components=self.n_components, batch_size=self.batch_size)
+            # Chunks must not be smaller than the number of components
+            for start in range(0, len(features), self.batch_size):
+                end = start + self.batch_size
+                if len(features) - end < self.n_components:
+                    end = len(features)
+                pca.partial_fit(np.asarray(features[start:end], dtype=np.float64))
+                if end == len(features):
+                    break
+        else:
+            pca = PCA(n_components=self.n_components, svd_solver=method, random_state=self.random_state)
+            pca.fit(np.asarray(features, dtype=np.float64))
+
+        projection = np.empty((len(features), self.n_components), dtype=np.float32)
+        for start in range(0, len(features), self.batch_size):
+            chunk = np.asarray(features[start:start + self.batch_size], dtype=np.float64)
+            projection[start:start + self.batch_size] = pca.transform(chunk)
+
+        return pca.mean_.astype(np.float32), pca.components_.astype(np.float32), projection
+
+    def _early_fusion(self) -> None:
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+        projections = []
+        source_ids = []
+        for i, dataset in enumerate((self.d1, self.d2), start=1):
+            ids, features = self._source(dataset)
+            mean, components, projection = self._fit_pca(features)
+            np.savez(self.directory / f"pca_{i}.npz", mean=mean, components=components)
+            projections.append(projection)
+            source_ids.append(ids)
+
+        # Inner join on the song id in the order of d1 (like pd.merge)
+        d2_id_to_row = {song_id: row for row, song_id in enumerate(source_ids[1])}
+        d2_rows = np.array([d2_id_to_row.get(song_id, -1) for song_id in source_ids[0]], dtype=np.int64)
+        in_both = d2_rows >= 0
 
-        return new_df
+        ids = np.asarray(source_ids[0][in_both], dtype=str)
+        features = np.hstack([projections[0][in_both], projections[1][d2_rows[in_both]]])
+        matrix = normalize_rows(features)
+        columns = [
+            f"{dataset.name}_{i + 1}" for dataset in (self.d1, self.d2) for i in range(self.n_components)
+        ]
 
-    def _early_fusion(self) -> pd.DataFrame:
-        pca1 = self.get_pca_df(self.d1)
-        pca2 = self.get_pca_df(self.d2)
-        return pd.merge(pca1, pca2, on="id")
+        _save_npy_atomic(self.directory / "ids.npy", ids)
+        _save_npy_atomic(self.directory / "features.npy", features)
+        _save_npy_atomic(self.directory / "matrix.npy", matrix)
 
-    # def save(self) -> None:
-    #    # Save the result to a TSV file
-    #    output_filename = f"early_fusion_{self.d1.name}_{self.d2.name}_{self.n_components}"
-    #    self.df.to_csv(output_filename, sep="\t", index=False)
+        # meta.json is written last since it marks the result as complete
+        meta = {
+            "columns": columns,
+            "fingerprint": LocalDataset.from_arrays(
+                "early_fusion", ids, features, columns, matrix, self.build_params
+            ).fingerprint,
+        }
+        tmp_path = self.directory / "meta.json.tmp"
+        with tmp_path.open("w") as fp:
+            json.dump(meta, fp)
+        tmp_path.replace(self.directory / "meta.json")
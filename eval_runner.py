@@ -0,0 +1,174 @@
+import multiprocessing
+import os
+import pickle
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+from typing import Any, Optional
+
+from evaluation import Evaluation, Metric, MetricState
+from genres import Genres
+from progress import tqdm
+from retrieval import Retrieval, RETRIEVAL_SYSTEMS
+from result_cache import result_cache
+from retrieval_systems import LateFusionSystem, get_spec
+from utils import unpickle_file
+
+# Number of queries per work unit (and checkpoint)
+DEFAULT_CHUNK_SIZE = 10_000
+
+# Set in the parent before the pool is started; forked workers inherit them without copying
+_shared_genres: Optional[Genres] = None
+_shared_metrics: Optional[list[Metric]] = None
+
+# The evaluation of a worker process
+_worker_evaluation: Optional[Evaluation] = None
+
+
+def _init_worker(metrics: list[Metric], retrieval_n: int, block_size: int) -> None:
+    global _worker_evaluation
+
+    # Spawned (instead of forked) workers load the genres themselves
+    genres = _shared_genres if _shared_genres is not None else Genres()
+    metrics = _shared_metrics if _shared_metrics is not None else metrics
+
+    # Each worker opens the (memory-mapped) retrieval caches on its own. The depth must
+    # match the parent's, since e.g. late fusion results depend on the depth of their inputs
+    _worker_evaluation = Evaluation(genres, metrics, Retrieval(n=retrieval_n), block_size=block_size)
+
+
+def _evaluate_unit(ret_sys_name: str, start: int, stop: int, checkpoint: Path) -> dict[str, MetricState]:
+    states = _worker_evaluation.partial(ret_sys_name, start, stop)
+    _write_checkpoint(checkpoint, states)
+    return states
+
+
+def _write_checkpoint(path: Path, data) -> None:
+    tmp_path = path.with_suffix(".tmp")
+    with tmp_path.open("wb") as fp:
+        pickle.dump(data, fp, protocol=pickle.HIGHEST_PROTOCOL)
+    # An interrupted write never leaves a truncated checkpoint behind
+    tmp_path.replace(path)
+
+
+class EvaluationRunner:
+    """
+    Runs an `Evaluation` of many retrieval systems on a pool of processes. The work is
+    split into (system x chunk of queries) units; every finished unit is checkpointed
+    in 'pickled_state/<cache_name>/' under the system's result cache key (see
+    `Evaluation.cache_key`), so an interrupted run resumes with the missing units only.
+    The partial metric states of a system are merged in the order of the chunks, which
+    makes the results independent of the order the units finish in.
+
+    Workers are forked where possible and then share the genre data (and e.g. the
+    ideal DCGs) with the parent; the retrieval caches are memory-mapped by every worker.
+    """
+
+    def __init__(
+            self,
+            evaluation: Evaluation,
+            processes: Optional[int] = None,
+            chunk_size: int = DEFAULT_CHUNK_SIZE,
+    ):
+        self.evaluation = evaluation
+        self.processes = processes or os.cpu_count() or 1
+        self.chunk_size = chunk_size
+        self._keys: dict[str, str] = {}
+
+    def chunks(self) -> list[tuple[int, int]]:
+        n_queries = len(self.evaluation.genres.get_song_ids())
+        return [(start, min(start + self.chunk_size, n_queries)) for start in range(0, n_queries, self.chunk_size)]
+
+    def _checkpoint_path(self, directory: Path, ret_sys_name: str, start: int, stop: int) -> Path:
+        return directory / f"{ret_sys_name}_{self._key(ret_sys_name)}_{start}_{stop}.pickle"
+
+    def _key(self, ret_sys_name: str) -> str:
+        # Fingerprints are only computed once per run
+        if ret_sys_name not in self._keys:
+            self._keys[ret_sys_name] = self.evaluation.cache_key(ret_sys_name)
+        return self._keys[ret_sys_name]
+
+    def _prepare(self, ret_sys_name: str) -> None:
+        # Top-k lists are computed in the parent, so that workers only read them
+        spec = get_spec(ret_sys_name)
+        if isinstance(spec, LateFusionSystem):
+            for name in spec.system_names:
+                self._prepare(name)
+        elif spec.dataset_backed:
+            self.evaluation.retrieval.precompute_dataset(spec.dataset())
+
+    def partial_states(self, ret_sys_names: list[str], directory: Path) -> dict[str, dict[str, MetricState]]:
+        """Merged metric states of every system; only units without a checkpoint in `directory` are computed."""
+        directory.mkdir(parents=True, exist_ok=True)
+        chunks = self.chunks()
+
+        unit_states: dict[tuple[str, int], dict[str, MetricState]] = {}
+        missing = []
+        for ret_sys_name in ret_sys_names:
+            for start, stop in chunks:
+                states = unpickle_file(str(self._checkpoint_path(directory, ret_sys_name, start, stop)))
+                if states is None:
+                    missing.append((ret_sys_name, start, stop))
+                else:
+                    unit_states[ret_sys_name, start] = states
+
+        if missing:
+            print(f"Evaluating {len(missing)} of {len(ret_sys_names) * len(chunks)} work units "
+                  f"on {self.processes} processes")
+            for ret_sys_name in dict.fromkeys(ret_sys_name for ret_sys_name, _, _ in missing):
+                self._prepare(ret_sys_name)
+            # Computes e.g. the ideal DCGs once, before the workers are started
+            self.evaluation.new_states()
+            self._run_units(missing, directory, unit_states)
+
+        merged = {}
+        for ret_sys_name in ret_sys_names:
+            states = self.evaluation.new_states()
+            for start, _ in chunks:
+                states = self.evaluation.merge(states, unit_states[ret_sys_name, start])
+            merged[ret_sys_name] = states
+        return merged
+
+    def _run_units(self, units: list[tuple[str, int, int]], directory: Path, unit_states: dict) -> None:
+        global _shared_genres, _shared_metrics
+
+        methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context("fork" if "fork" in methods else None)
+
+        _shared_genres, _shared_metrics = self.evaluation.genres, self.evaluation.metrics
+        try:
+            with ProcessPoolExecutor(
+                    max_workers=self.processes,
+                    mp_context=context,
+                    initializer=_init_worker,
+                    initargs=(self.evaluation.metrics, self.evaluation.retrieval.n, self.evaluation.block_size),
+            ) as executor:
+                futures = {
+                    executor.submit(
+                        _evaluate_unit, ret_sys_name, start, stop,
+                        self._checkpoint_path(directory, ret_sys_name, start, stop),
+                    ): (ret_sys_name, start)
+                    for ret_sys_name, start, stop in units
+                }
+                for future in tqdm(as_completed(futures), total=len(futures), desc="Evaluating work units"):
+                    unit_states[futures[future]] = future.result()
+        finally:
+            _shared_genres, _shared_metrics = None, None
+
+    def run(self, cache_name: str, ret_sys_names: Optional[list[str]] = None) -> dict[str, dict[str, Any]]:
+        """
+        Same results as `Evaluation.run` (and the same result cache entries), computed
+        in parallel with the checkpoints in 'pickled_state/<cache_name>/'.
+        """
+        ret_sys_names = ret_sys_names or list(RETRIEVAL_SYSTEMS)
+        self._keys = {}
+        results = {name: result_cache.load(f"{cache_name}_{name}", self._key(name)) for name in ret_sys_names}
+
+        missing = [name for name, result in results.items() if result is None]
+        if missing:
+            states = self.partial_states(missing, Path("pickled_state") / cache_name)
+            for name in missing:
+                results[name] = self.evaluation.finalize(states[name])
+                result_cache.store(
+                    f"{cache_name}_{name}", self._key(name), results[name], self.evaluation.dependencies(name)
+                )
+        return results
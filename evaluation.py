@@ -0,0 +1,349 @@
+import sys
+from functools import cached_property
+from typing import Any, Optional
+
+import numpy as np
+from scipy import sparse
+
+from genres import Genres
+from progress import tqdm
+from result_cache import code_version, result_cache
+from retrieval import Retrieval, RETRIEVAL_SYSTEMS
+from retrieval_systems import get_spec
+
+# Number of queries whose result matrices are materialized at once
+QUERY_BLOCK_SIZE = 4096
+
+# Partial sums of a metric, merged by adding them up
+MetricState = dict[str, np.ndarray]
+
+
+def _code_version() -> str:
+    # Results are recomputed whenever the metrics' code changes
+    return code_version(sys.modules[__name__])
+
+
+class EvaluationBlock:
+    """
+    The top-k lists of a block of queries, shared by all metrics of a pass. Queries and
+    retrieved songs are rows of the genre incidence matrix (-1 for songs without genres).
+    Derived matrices (e.g. the shared genre counts) are computed once, on first use.
+    """
+
+    def __init__(self, genres: Genres, query_rows: np.ndarray, retrieved_song_rows: np.ndarray):
+        self.genres = genres
+        self.query_rows = query_rows
+        # Number of retrieved songs per query and depth (songs without genres included)
+        self.n_results = np.cumsum(retrieved_song_rows >= 0, axis=1)
+        self.retrieved = genres.rows_of_song_rows(retrieved_song_rows)
+        self.valid = self.retrieved >= 0
+
+    def __len__(self) -> int:
+        return len(self.query_rows)
+
+    @cached_property
+    def shared(self) -> np.ndarray:
+        """(queries x depth) number of genres each retrieved song shares with its query."""
+        shared = np.zeros(self.retrieved.shape, dtype=np.int64)
+        queries = np.broadcast_to(self.query_rows[:, None], self.retrieved.shape)
+        shared[self.valid] = self.genres.shared_genre_counts(queries[self.valid], self.retrieved[self.valid])
+        return shared
+
+    @cached_property
+    def related(self) -> np.ndarray:
+        return self.shared > 0
+
+
+class Metric:
+    """
+    A metric that is accumulated over blocks of queries. Its state consists of arrays
+    of partial sums, so that the states of any split of the queries can be merged by
+    adding them up; `finalize` turns the merged state into the metric's result.
+    """
+    name: str
+    # Depth of the result lists the metric looks at
+    n: int
+
+    def new_state(self, genres: Genres) -> MetricState:
+        raise NotImplementedError
+
+    def update(self, state: MetricState, block: EvaluationBlock) -> None:
+        raise NotImplementedError
+
+    def merge(self, state: MetricState, other: MetricState) -> MetricState:
+        return {key: state[key] + other[key] for key in state}
+
+    def finalize(self, state: MetricState) -> Any:
+        raise NotImplementedError
+
+
+class PrecisionRecallMetric(Metric):
+    """Precision@k and recall@k for every k up to n, as arrays of length n + 1 indexed by k."""
+
+    def __init__(self, n: int = 100):
+        self.name = "precision_recall"
+        self.n = n
+
+    def new_state(self, genres: Genres) -> MetricState:
+        return {"precision": np.zeros(self.n), "recall": np.zeros(self.n), "n_queries": np.zeros(())}
+
+    def update(self, state: MetricState, block: EvaluationBlock) -> None:
+        relevant_until_k = np.cumsum(block.related[:, :self.n], axis=1)
+        state["precision"] += (relevant_until_k / np.arange(1, self.n + 1)).sum(axis=0)
+
+        # Sanity check: Prevent division by 0
+        n_relevant = block.genres.relevant_counts[block.query_rows, None]
+        state["recall"] += np.divide(
+            relevant_until_k, n_relevant,
+            out=np.zeros(relevant_until_k.shape), where=n_relevant > 0,
+        ).sum(axis=0)
+        state["n_queries"] += len(block)
+
+    def finalize(self, state: MetricState) -> tuple[np.ndarray, np.ndarray]:
+        n_queries = max(float(state["n_queries"]), 1.0)
+        return np.r_[np.nan, state["precision"] / n_queries], np.r_[np.nan, state["recall"] / n_queries]
+
+
+class NdcgMetric(Metric):
+    """Mean nDCG@n with the Dice coefficient of the genre sets as relevance."""
+
+    def __init__(self, n: int = 10):
+        self.name = "ndcg"
+        self.n = n
+        self._ideal: Optional[np.ndarray] = None
+
+    def new_state(self, genres: Genres) -> MetricState:
+        if self._ideal is None:
+            self._ideal = ideal_dcg(genres, self.n)
+        return {"ndcg": np.zeros(()), "n_queries": np.zeros(())}
+
+    def update(self, state: MetricState, block: EvaluationBlock) -> None:
+        retrieved = block.retrieved[:, :self.n]
+        relevance = dice_relevance(
+            block.genres, block.shared[:, :self.n], block.query_rows[:, None], np.maximum(retrieved, 0)
+        )
+        state["ndcg"] += ndcg_from_relevance(relevance, self._ideal[block.query_rows]).sum()
+        state["n_queries"] += len(block)
+
+    def finalize(self, state: MetricState) -> float:
+        return float(state["ndcg"] / max(float(state["n_queries"]), 1.0))
+
+
+class GenreCoverageMetric(Metric):
+    """Fraction of all genres that occur among the top-n songs of any query."""
+
+    def __init__(self, n: int = 10):
+        self.name = "genre_coverage"
+        self.n = n
+
+    def new_state(self, genres: Genres) -> MetricState:
+        return {"genre_hits": np.zeros(genres.incidence.shape[1])}
+
+    def update(self, state: MetricState, block: EvaluationBlock) -> None:
+        retrieved = block.retrieved[:, :self.n]
+        retrieved_songs = np.unique(retrieved[retrieved >= 0])
+        genre_ids = block.genres.incidence[retrieved_songs].indices
+        state["genre_hits"] += np.bincount(genre_ids, minlength=len(state["genre_hits"]))
+
+    def finalize(self, state: MetricState) -> float:
+        return float((state["genre_hits"] > 0).sum() / len(state["genre_hits"]))
+
+
+class GenreDiversityMetric(Metric):
+    """Mean Shannon entropy of the genre distribution of the top-n songs (see `genre_entropies`)."""
+
+    def __init__(self, n: int = 10):
+        self.name = "genre_diversity"
+        self.n = n
+
+    def new_state(self, genres: Genres) -> MetricState:
+        return {"entropy": np.zeros(()), "n_queries": np.zeros(())}
+
+    def update(self, state: MetricState, block: EvaluationBlock) -> None:
+        entropies = genre_entropies(block.genres, block.retrieved[:, :self.n], block.n_results[:, self.n - 1])
+        state["entropy"] += entropies.sum()
+        state["n_queries"] += len(block)
+
+    def finalize(self, state: MetricState) -> float:
+        return float(state["entropy"] / max(float(state["n_queries"]), 1.0))
+
+
+class Evaluation:
+    """
+    Computes any number of metrics in a single pass: the top-k lists of a retrieval
+    system are fetched once (as a matrix, see `Retrieval.top_k_arrays`) and streamed
+    in blocks of queries through every metric.
+    """
+
+    def __init__(
+            self,
+            genres: Genres,
+            metrics: list[Metric],
+            retrieval: Optional[Retrieval] = None,
+            block_size: int = QUERY_BLOCK_SIZE,
+    ):
+        self.genres = genres
+        self.metrics = metrics
+        self.depth = max(metric.n for metric in metrics)
+        self.block_size = block_size
+
+        self._ret = retrieval if retrieval else Retrieval(n=self.depth)
+        if self._ret.n < self.depth:
+            raise ValueError(f"The retrieval depth ({self._ret.n}) is smaller than the metrics' depth ({self.depth})")
+
+    @property
+    def retrieval(self) -> Retrieval:
+        return self._ret
+
+    def new_states(self) -> dict[str, MetricState]:
+        return {metric.name: metric.new_state(self.genres) for metric in self.metrics}
+
+    def merge(self, states: dict[str, MetricState], other: dict[str, MetricState]) -> dict[str, MetricState]:
+        return {metric.name: metric.merge(states[metric.name], other[metric.name]) for metric in self.metrics}
+
+    def finalize(self, states: dict[str, MetricState]) -> dict[str, Any]:
+        return {metric.name: metric.finalize(states[metric.name]) for metric in self.metrics}
+
+    def accumulate(self, retrieved_song_rows: np.ndarray, query_rows: np.ndarray) -> dict[str, MetricState]:
+        """
+        Partial metric states of the given top-k lists.
+
+        :param retrieved_song_rows: (queries x depth) retrieved songs as rows of `songs.info` (-1 = none).
+        :param query_rows: Rows of the queries in the genre incidence matrix.
+        """
+        states = self.new_states()
+        for start in range(0, len(query_rows), self.block_size):
+            block = EvaluationBlock(
+                self.genres,
+                query_rows[start:start + self.block_size],
+                retrieved_song_rows[start:start + self.block_size, :self.depth],
+            )
+            for metric in self.metrics:
+                metric.update(states[metric.name], block)
+        return states
+
+    def partial(self, ret_sys_name: str, start: int = 0, stop: Optional[int] = None) -> dict[str, MetricState]:
+        """Partial metric states of `ret_sys_name` over the queries start:stop (all songs with genres)."""
+        query_ids = self.genres.get_song_ids()
+        query_rows = np.arange(len(query_ids))[start:stop]
+
+        retrieved, _ = self._ret.top_k_arrays(ret_sys_name, query_ids[start:stop])
+        return self.accumulate(retrieved, query_rows)
+
+    def evaluate(self, ret_sys_name: str) -> dict[str, Any]:
+        return self.finalize(self.partial(ret_sys_name))
+
+    @property
+    def params(self) -> dict:
+        return {
+            "metrics": [(type(metric).__name__, metric.n) for metric in self.metrics],
+            "retrieval_n": self._ret.n,
+        }
+
+    def dependencies(self, ret_sys_name: str) -> dict[str, str]:
+        """Fingerprints of the data the results of `ret_sys_name` are computed from."""
+        return {"genres": self.genres.fingerprint, ret_sys_name: get_spec(ret_sys_name).fingerprint()}
+
+    def cache_key(self, ret_sys_name: str) -> str:
+        return result_cache.key(self.params, self.dependencies(ret_sys_name), _code_version())
+
+    def cached(self, ret_sys_name: str, cache_name: str) -> dict[str, Any]:
+        """`evaluate(ret_sys_name)`, stored in the result cache as '<cache_name>_<system>'."""
+        return result_cache.get_or_compute(
+            f"{cache_name}_{ret_sys_name}",
+            lambda: self.evaluate(ret_sys_name),
+            params=self.params,
+            dependencies=self.dependencies(ret_sys_name),
+            code=_code_version(),
+        )
+
+    def run(self, ret_sys_names: Optional[list[str]] = None, cache_name: Optional[str] = None) -> dict[str, dict[str, Any]]:
+        """
+        Results of all metrics for every given (default: all) retrieval system.
+
+        :param cache_name: If given, the results of every system are cached as '<cache_name>_<system>' (see `cached`).
+        """
+        results = {}
+        for ret_sys_name in tqdm(ret_sys_names or list(RETRIEVAL_SYSTEMS), desc="Evaluating retrieval systems"):
+            if cache_name is None:
+                results[ret_sys_name] = self.evaluate(ret_sys_name)
+            else:
+                results[ret_sys_name] = self.cached(ret_sys_name, cache_name)
+        return results
+
+
+def position_weights(n: int) -> np.ndarray:
+    # The first two results are not discounted, the i-th (i >= 1) by log2(i + 1)
+    return np.r_[1.0, 1.0 / np.log2(np.arange(2, n + 1))]
+
+
+def dice_relevance(genres: Genres, shared: np.ndarray, query_rows: np.ndarray, other_rows: np.ndarray) -> np.ndarray:
+    """Dice coefficient of the genre sets from their shared genre counts (0 for songs without genres)."""
+    total = genres.genre_counts[query_rows] + genres.genre_counts[other_rows]
+    return np.divide(2 * shared, total, out=np.zeros(shared.shape), where=shared > 0)
+
+
+# Peak bytes per (query, song) pair of a block while computing the ideal DCG: the float32
+# shared genre counts, and in `dice_relevance` the (int64) genre count sums, the doubled
+# float32 counts, the boolean mask and the float64 relevance
+IDEAL_DCG_BYTES_PER_ENTRY = 4 + 8 + 4 + 1 + 8
+
+
+def ideal_dcg(genres: Genres, n: int) -> np.ndarray:
+    """
+    DCG of the n most relevant songs (the query itself included) for every song in
+    `genres`, computed from blocks of the genre incidence matrix product.
+    """
+    def compute() -> np.ndarray:
+        weights = position_weights(n)
+        all_rows = np.arange(len(genres.get_song_ids()))
+
+        ideal = np.empty(len(all_rows))
+        for rows, shared in genres.shared_genre_blocks(bytes_per_entry=IDEAL_DCG_BYTES_PER_ENTRY):
+            relevance = dice_relevance(genres, shared, rows[:, None], all_rows[None, :])
+            # Negated and partitioned in place, the relevance is never copied
+            np.negative(relevance, out=relevance)
+            relevance.partition(n - 1, axis=1)
+            ideal[rows] = np.sort(relevance[:, :n], axis=1) @ -weights
+        return ideal
+
+    return result_cache.get_or_compute(
+        f"ideal_dcg_{n}", compute,
+        params={"n": n},
+        dependencies={"genres": genres.fingerprint},
+        code=code_version(position_weights, dice_relevance, ideal_dcg),
+    )
+
+
+def ndcg_from_relevance(relevance: np.ndarray, ideal: np.ndarray) -> np.ndarray:
+    """nDCG of every row of a (queries x n) relevance matrix, given the queries' ideal DCGs."""
+    dcg = relevance @ position_weights(relevance.shape[1])
+    return np.divide(dcg, ideal, out=np.zeros(len(dcg)), where=ideal != 0.0)
+
+
+def genre_entropies(genres: Genres, retrieved: np.ndarray, n_results: np.ndarray) -> np.ndarray:
+    """
+    Shannon entropy of the genre distribution of every query's retrieved songs.
+
+    Every retrieved song contributes 1 / #genres to each of its genres (a row of
+    `Genres.genre_weights`), and the distribution is normalized by the number of
+    retrieved songs (relative frequencies against top-K). The entropy is higher if
+    the genres are distributed more evenly and lower if they are concentrated in a few.
+
+    :param retrieved: (queries x n) retrieved songs as rows of the genre incidence matrix (-1 = no genres).
+    :param n_results: Number of retrieved songs per query (songs without genres included).
+    """
+    valid = retrieved >= 0
+    queries = np.broadcast_to(np.arange(len(retrieved))[:, None], retrieved.shape)[valid]
+    weights = np.divide(1.0, n_results, out=np.zeros(len(n_results)), where=n_results > 0)
+
+    # (queries x songs) matrix that averages the rows of the retrieved songs
+    selection = sparse.csr_matrix(
+        (weights[queries], (queries, retrieved[valid])),
+        shape=(len(retrieved), genres.incidence.shape[0]),
+    )
+    distributions = (selection @ genres.genre_weights).tocsr()
+
+    p = distributions.data
+    distributions.data = np.where(p > 0.0, -p * np.log2(np.where(p > 0.0, p, 1.0)), 0.0)
+    return np.asarray(distributions.sum(axis=1)).ravel()
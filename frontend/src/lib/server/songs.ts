@@ -1,35 +1,170 @@
 import path from "node:path";
 import * as fs from "node:fs";
 
-interface Retrieval {
-  [key: string]: [string, number][];
+// Written by frontend_export.export_frontend_shards()
+interface ShardManifest {
+  version: number;
+  generation: string;
+  n: number;
+  systems: string[];
+  shards: { file: string; first_id: string; last_id: string }[];
 }
 
+interface Shard {
+  ids: string[];
+  songs: number[];
+  meta: Song[];
+  results: Record<string, { neighbours: number[][]; scores: number[][] }>;
+}
+
+// Number of shards kept in memory
+const SHARD_CACHE_SIZE = 32;
+
 const getPath = (...filename: string[]) =>
   path.join(process.cwd(), "db", ...filename);
 
-const getRetrievals = async () => {
-  const dirPath = getPath("retrievals");
-  const files = await fs.promises.readdir(dirPath);
+let manifest: { mtimeMs: number; content: Promise<ShardManifest> } | undefined;
 
-  const map: Record<string, Retrieval> = {};
-  try {
-    for (const file of files) {
-      const filePath = path.join(dirPath, file);
-      const content = await fs.promises.readFile(filePath, "utf-8");
-      map[file] = JSON.parse(content);
+// Re-read whenever a new export has replaced the manifest. Shard file names are
+// unique per export, so cached shards of an older export are never mixed in.
+const getManifest = async (force = false) => {
+  const manifestPath = getPath("shards", "manifest.json");
+  const { mtimeMs } = await fs.promises.stat(manifestPath);
+  if (force || !manifest || manifest.mtimeMs !== mtimeMs) {
+    const content = fs.promises
+      .readFile(manifestPath, "utf-8")
+      .then((content) => JSON.parse(content) as ShardManifest);
+    manifest = { mtimeMs, content };
+    content.catch(() => {
+      if (manifest?.content === content) {
+        manifest = undefined;
+      }
+    });
+  }
+  return manifest.content;
+};
+
+const shardCache = new Map<string, Promise<Shard>>();
+
+const loadShard = (file: string) => {
+  let shard = shardCache.get(file);
+  if (shard) {
+    // Most recently used shards are at the end of the map
+    shardCache.delete(file);
+  } else {
+    shard = fs.promises
+      .readFile(getPath("shards", file), "utf-8")
+      .then((content) => JSON.parse(content) as Shard);
+    shard.catch(() => shardCache.delete(file));
+  }
+  shardCache.set(file, shard);
+
+  if (shardCache.size > SHARD_CACHE_SIZE) {
+    shardCache.delete(shardCache.keys().next().value!);
+  }
+  return shard;
+};
+
+const isMissingFile = (e: unknown) => (e as NodeJS.ErrnoException).code === "ENOENT";
+
+const findShardFile = ({ shards }: ShardManifest, songId: string) => {
+  // Shards hold consecutive ranges of the sorted song ids
+  let low = 0;
+  let high = shards.length - 1;
+  while (low <= high) {
+    const mid = (low + high) >> 1;
+    if (songId < shards[mid].first_id) {
+      high = mid - 1;
+    } else if (songId > shards[mid].last_id) {
+      low = mid + 1;
+    } else {
+      return shards[mid].file;
     }
+  }
+  return undefined;
+};
+
+const loadShardOfSong = async (songId: string) => {
+  const file = findShardFile(await getManifest(), songId);
+  if (!file) {
+    return undefined;
+  }
+  try {
+    return await loadShard(file);
   } catch (e) {
-    console.error("getRetrievals(): ", e);
+    if (!isMissingFile(e)) {
+      throw e;
+    }
+    // The shards of a newer export have replaced the ones of the cached manifest
+    const current = findShardFile(await getManifest(true), songId);
+    return current ? loadShard(current) : undefined;
   }
-  return map;
 };
 
-const getMetadata = async () => {
-  const path = getPath("songMeta.json");
-  const content = await fs.promises.readFile(path, "utf-8");
-  return JSON.parse(content) as Song[];
+const compareIds = (a: string, b: string) => (a < b ? -1 : a > b ? 1 : 0);
+
+export const getSongResults = async (songId: string, n = 10) => {
+  const shard = await loadShardOfSong(songId);
+  if (!shard) {
+    return undefined;
+  }
+
+  let low = 0;
+  let high = shard.ids.length - 1;
+  let position = -1;
+  while (low <= high) {
+    const mid = (low + high) >> 1;
+    const order = compareIds(songId, shard.ids[mid]);
+    if (order === 0) {
+      position = mid;
+      break;
+    }
+    if (order < 0) {
+      high = mid - 1;
+    } else {
+      low = mid + 1;
+    }
+  }
+  if (position < 0) {
+    return undefined;
+  }
+
+  const results: Record<string, Song[]> = {};
+  for (const [system, { neighbours, scores }] of Object.entries(shard.results)) {
+    results[system] = neighbours[position]
+      .slice(0, n)
+      .flatMap((index, rank) =>
+        index < 0 ? [] : [{ ...shard.meta[index], score: scores[position][rank] }],
+      );
+  }
+
+  return { song: shard.meta[shard.songs[position]], results };
 };
 
-export const metadata = await getMetadata();
-export const retrievals = await getRetrievals();
+// Songs of a shard are spread evenly over the catalog (ids are random), so a
+// random sample of one shard is a random sample of all songs
+export const getRandomSongs = async (count: number, attempts = 2): Promise<Song[]> => {
+  const { shards } = await getManifest(attempts < 2);
+  if (!shards.length) {
+    return [];
+  }
+
+  let shard: Shard;
+  try {
+    shard = await loadShard(shards[Math.floor(Math.random() * shards.length)].file);
+  } catch (e) {
+    if (!isMissingFile(e) || attempts <= 1) {
+      throw e;
+    }
+    return getRandomSongs(count, attempts - 1);
+  }
+
+  // Partial Fisher-Yates shuffle of the shard's positions
+  const positions = shard.ids.map((_, i) => i);
+  const sampleSize = Math.min(count, positions.length);
+  for (let i = 0; i < sampleSize; i++) {
+    const j = i + Math.floor(Math.random() * (positions.length - i));
+    [positions[i], positions[j]] = [positions[j], positions[i]];
+  }
+  return positions.slice(0, sampleSize).map((i) => shard.meta[shard.songs[i]]);
+};
@@ -0,0 +1,116 @@
+import json
+import os
+import time
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+
+from datasets import datasets
+from retrieval import Retrieval, RETRIEVAL_SYSTEMS
+from song import songs
+from utils import song_meta_df
+
+DEFAULT_SHARD_DIRECTORY = Path("frontend") / "db" / "shards"
+DEFAULT_SONGS_PER_SHARD = 500
+
+SHARD_FORMAT_VERSION = 1
+
+
+def song_metadata() -> pd.DataFrame:
+    """Frontend metadata (id, artist, song, ytId, genres) of every song in the information table."""
+    return song_meta_df(songs.info, datasets.url.df, datasets.genres.df)
+
+
+def _write_json_atomic(path: Path, data) -> None:
+    tmp_path = path.with_name(path.name + ".tmp")
+    with tmp_path.open("w", encoding="utf-8") as fp:
+        json.dump(data, fp, separators=(",", ":"), ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+def export_frontend_shards(
+        directory: Path = DEFAULT_SHARD_DIRECTORY,
+        retrieval: Optional[Retrieval] = None,
+        ret_sys_names: Optional[list[str]] = None,
+        n: int = 10,
+        songs_per_shard: int = DEFAULT_SONGS_PER_SHARD,
+) -> None:
+    """
+    Writes the top-n results of the given (default: all but the random baseline)
+    retrieval systems for the frontend, sharded by song id.
+
+    Songs are sorted by id and split into shards of `songs_per_shard` consecutive
+    songs, so that 'manifest.json' only lists the first and last id of every shard.
+    Every export is a new generation with its own shard file names, which only become
+    visible once the manifest is replaced; the files of older generations are removed
+    afterwards, so a reader never mixes the id ranges of one export with the shards of
+    another. A shard holds, for each of its songs, the result lists of all systems as
+    indices into the shard's own metadata table, which contains every song that occurs
+    in it:
+
+        {"ids": [song ids], "songs": [metadata index of each song], "meta": [metadata],
+         "results": {system: {"neighbours": [[metadata index, ...], ...], "scores": [[...], ...]}}}
+
+    Missing results are padded with -1 (and a score of 0).
+    """
+    retrieval = retrieval if retrieval else Retrieval(n=n)
+    ret_sys_names = ret_sys_names or [name for name in RETRIEVAL_SYSTEMS if name != "random_baseline"]
+    directory.mkdir(parents=True, exist_ok=True)
+
+    metadata = song_metadata()
+    records = metadata.to_dict("records")
+    all_ids = songs.info["id"].to_numpy()
+
+    # All results as rows of the information table
+    results = {}
+    for ret_sys_name in ret_sys_names:
+        print(f"Collecting the top-{n} results of '{ret_sys_name}'")
+        neighbours, scores = retrieval.top_k_arrays(ret_sys_name, all_ids)
+        results[ret_sys_name] = (neighbours[:, :n], np.nan_to_num(scores[:, :n]).round(5))
+
+    order = np.argsort(all_ids, kind="stable")
+    generation = f"{time.time_ns():x}"
+    shards = []
+    for shard, start in enumerate(range(0, len(order), songs_per_shard)):
+        shard_rows = order[start:start + songs_per_shard]
+
+        # The shard's metadata table: its songs and all of their neighbours
+        neighbour_rows = [neighbours[shard_rows] for neighbours, _ in results.values()]
+        meta_rows = np.unique(np.concatenate([shard_rows] + [rows[rows >= 0] for rows in neighbour_rows]))
+
+        def local(rows: np.ndarray) -> np.ndarray:
+            return np.where(rows >= 0, np.searchsorted(meta_rows, rows), -1)
+
+        file_name = f"shard_{generation}_{shard:05d}.json"
+        _write_json_atomic(directory / file_name, {
+            "ids": all_ids[shard_rows].tolist(),
+            "songs": local(shard_rows).tolist(),
+            "meta": [records[row] for row in meta_rows.tolist()],
+            "results": {
+                ret_sys_name: {
+                    "neighbours": local(rows).tolist(),
+                    "scores": np.where(rows >= 0, results[ret_sys_name][1][shard_rows], 0.0).tolist(),
+                }
+                for ret_sys_name, rows in zip(results, neighbour_rows)
+            },
+        })
+        shards.append({"file": file_name, "first_id": all_ids[shard_rows[0]], "last_id": all_ids[shard_rows[-1]]})
+
+    # The manifest is written last, it makes the new shards visible
+    _write_json_atomic(directory / "manifest.json", {
+        "version": SHARD_FORMAT_VERSION,
+        "generation": generation,
+        "n": n,
+        "systems": ret_sys_names,
+        "shards": shards,
+    })
+
+    # Shards of earlier generations
+    current = {shard["file"] for shard in shards}
+    for p in directory.glob("shard_*.json"):
+        if p.name not in current:
+            p.unlink()
+
+    print(f"Exported {len(order)} songs of {len(ret_sys_names)} retrieval systems into {len(shards)} shards in '{directory}'")
@@ -1,10 +1,32 @@
+import hashlib
 import json
 from typing import Optional
-from tqdm.notebook import tqdm
+
+import numpy as np
+from scipy import sparse
 
 from datasets import datasets
+from progress import tqdm
+from song import songs
 from utils import unpickle_or_compute
 
+# Memory budget (in bytes) of all (queries x songs) temporaries of one block of shared genre counts
+DEFAULT_GENRE_BLOCK_MEMORY_BUDGET = 64 * 1024 ** 2
+
+# Peak bytes per (query, song) pair of a block: the sparse float32 product (values and
+# int32 indices, dense in the worst case) and the dense float32 counts
+SHARED_GENRE_BYTES_PER_ENTRY = 4 + 4 + 4
+
+
+_POPCOUNT = np.array([bin(byte).count("1") for byte in range(256)], dtype=np.int64)
+
+
+def _popcount(bits: np.ndarray) -> int:
+    if hasattr(np, "bitwise_count"):
+        # numpy >= 2.0
+        return int(np.bitwise_count(bits).sum())
+    return int(_POPCOUNT[bits.view(np.uint8)].sum())
+
 
 class Genres:
     """Precomputes some data for the analysis and caches it on disk."""
@@ -15,6 +37,24 @@ class Genres:
         self.song_genre_map: dict[int, set[str]] = data['song_genre_map']
         self.relevant_song_counts: dict[int, int] = data['relevant_song_counts']
 
+        if not hasattr(self, "incidence"):
+            self._build_incidence()
+
+        # Relevant song counts in the row order of the incidence matrix
+        self.relevant_counts = np.array([self.relevant_song_counts[song_id] for song_id in self.song_ids], dtype=np.int64)
+        self._fingerprint: Optional[str] = None
+
+    @property
+    def fingerprint(self) -> str:
+        """Content hash of the songs and their genres."""
+        if self._fingerprint is None:
+            # Genre sets are sorted, since the order of set iteration differs between processes
+            h = hashlib.blake2b(digest_size=16)
+            for song_id in self.song_ids:
+                h.update(f"{song_id}\t{'|'.join(sorted(self.song_genre_map[song_id]))}\n".encode("utf-8"))
+            self._fingerprint = h.hexdigest()
+        return self._fingerprint
+
     def get_song_genre(self, song_id: int) -> Optional[set[str]]:
         return self.song_genre_map.get(song_id, None)
 
@@ -24,9 +64,92 @@ class Genres:
     def get_relevant_song_counts(self, song_id) -> int:
         return self.relevant_song_counts.get(song_id, 0)
 
+    def rows_of(self, song_ids) -> np.ndarray:
+        """Rows of `song_ids` in :attr:`incidence` (-1 for songs without genre information)."""
+        return np.fromiter(
+            (self.song_to_row.get(song_id, -1) for song_id in song_ids), dtype=np.int64, count=len(song_ids)
+        )
+
+    def rows_of_song_rows(self, song_rows: np.ndarray) -> np.ndarray:
+        """Translates rows of `songs.info` (e.g. results of `Retrieval.top_k_arrays`) into rows of :attr:`incidence`."""
+        if self._song_row_to_row is None:
+            self._song_row_to_row = self.rows_of(songs.info["id"].to_numpy())
+        return np.where(song_rows >= 0, self._song_row_to_row[np.maximum(song_rows, 0)], -1)
+
+    def incidence_for(self, song_ids) -> sparse.csr_matrix:
+        """Rows of :attr:`incidence` in the order of `song_ids`; songs without genres get empty rows."""
+        rows = self.rows_of(song_ids)
+        known = sparse.diags((rows >= 0).astype(np.float32))
+        return (known @ self.incidence[np.maximum(rows, 0)]).tocsr()
+
+    def shared_genre_counts(self, rows_a: np.ndarray, rows_b: np.ndarray) -> np.ndarray:
+        """Number of shared genres of the song pairs (rows_a[i], rows_b[i]), for any (equal) shape of rows."""
+        rows_a, rows_b = np.broadcast_arrays(np.asarray(rows_a), np.asarray(rows_b))
+        shared = self.incidence[rows_a.ravel()].multiply(self.incidence[rows_b.ravel()]).sum(axis=1)
+        return np.asarray(shared, dtype=np.int64).reshape(rows_a.shape)
+
+    def related_mask(self, rows_a: np.ndarray, rows_b: np.ndarray) -> np.ndarray:
+        """Whether the song pairs (rows_a[i], rows_b[i]) share at least one genre (see `is_related`)."""
+        return self.shared_genre_counts(rows_a, rows_b) > 0
+
+    def block_size(
+            self,
+            memory_budget: int = DEFAULT_GENRE_BLOCK_MEMORY_BUDGET,
+            bytes_per_entry: int = SHARED_GENRE_BYTES_PER_ENTRY,
+    ) -> int:
+        """Number of query rows per block, such that `bytes_per_entry` bytes for each (query, song) pair fit the budget."""
+        return max(1, memory_budget // (bytes_per_entry * max(1, len(self.song_ids))))
+
+    def shared_genre_blocks(
+            self,
+            query_rows: Optional[np.ndarray] = None,
+            memory_budget: int = DEFAULT_GENRE_BLOCK_MEMORY_BUDGET,
+            bytes_per_entry: int = SHARED_GENRE_BYTES_PER_ENTRY,
+    ):
+        """
+        Yields (query rows, dense (block x songs) shared genre counts) for blocks of
+        the given (default: all) query rows, computed as sparse matrix products.
+        Callers that derive further (block x songs) arrays from the counts pass the
+        bytes of all of them per pair as `bytes_per_entry`, so that the block size
+        keeps their peak memory within the budget.
+        """
+        if query_rows is None:
+            query_rows = np.arange(len(self.song_ids))
+
+        block_size = self.block_size(memory_budget, max(bytes_per_entry, SHARED_GENRE_BYTES_PER_ENTRY))
+        incidence_t = self.incidence.T.tocsr()
+        for start in range(0, len(query_rows), block_size):
+            rows = query_rows[start:start + block_size]
+            yield rows, (self.incidence[rows] @ incidence_t).toarray()
+
+    def _build_incidence(self) -> None:
+        # Songs x genres 0/1 matrix with integer genre ids (in order of first occurrence)
+        self.song_to_row = {song_id: row for row, song_id in enumerate(self.song_ids)}
+        self.genre_to_id: dict[str, int] = {}
+
+        indptr, indices = [0], []
+        for song_id in self.song_ids:
+            indices.extend(self.genre_to_id.setdefault(genre, len(self.genre_to_id)) for genre in self.song_genre_map[song_id])
+            indptr.append(len(indices))
+
+        self.genre_names = list(self.genre_to_id)
+        self.incidence = sparse.csr_matrix(
+            (np.ones(len(indices), dtype=np.float32), np.array(indices, dtype=np.int32), np.array(indptr)),
+            shape=(len(self.song_ids), len(self.genre_to_id)),
+        )
+        self.genre_counts = np.diff(self.incidence.indptr)
+
+        # Every song spreads a weight of 1 evenly across its genres
+        self.genre_weights = (
+            sparse.diags(np.divide(1.0, self.genre_counts, out=np.zeros(len(self.song_ids)), where=self.genre_counts > 0))
+            @ self.incidence
+        ).tocsr()
+        self._song_row_to_row: Optional[np.ndarray] = None
+
     def _compute_data(self):
         self.song_genre_map = self._get_song_genre_map()
         self.song_ids = list(self.song_genre_map.keys())
+        self._build_incidence()
         self.relevant_song_counts = self._get_relevant_song_counts()
 
         return {
@@ -37,23 +160,44 @@ class Genres:
 
     def _get_song_genre_map(self) -> dict[int, set[str]]:
         song_genre_map: dict[int, set[str]] = {}
-        for _, row in datasets.genres.df.iterrows():
-            genre = row["genre"].replace("'", "\"")
-            song_genre_map[row["id"]] = set(json.loads(genre))
+        df = datasets.genres.df
+        for song_id, genre in zip(df["id"], df["genre"]):
+            song_genre_map[song_id] = set(json.loads(genre.replace("'", "\"")))
 
         print(f"Found {len(song_genre_map)} songs with genre information")
         return song_genre_map
 
     def _get_relevant_song_counts(self) -> dict[int, int]:
-        relevant_song_counts = {}
+        # Shared genre counts of all song pairs would be a dense N x N product. Instead,
+        # every genre gets a bitset of its songs; the songs related to a song are the
+        # union (OR) of the bitsets of its genres. Songs with the same genres share it.
+        n_songs, n_genres = self.incidence.shape
+        by_genre = self.incidence.tocsc()
+
+        # Bitsets are padded to whole 64-bit words
+        genre_bits = np.zeros((n_genres, -(-n_songs // 64) * 8), dtype=np.uint8)
+        for genre in range(n_genres):
+            members = np.zeros(n_songs, dtype=bool)
+            members[by_genre.indices[by_genre.indptr[genre]:by_genre.indptr[genre + 1]]] = True
+            genre_bits[genre, :-(-n_songs // 8)] = np.packbits(members)
+        genre_bits = genre_bits.view(np.uint64)
+
+        # Songs with the same genres share an index into unique_sets
+        set_index: dict[tuple[int, ...], int] = {}
+        set_of_song = np.array([
+            set_index.setdefault(tuple(sorted(self.incidence.indices[start:end].tolist())), len(set_index))
+            for start, end in zip(self.incidence.indptr, self.incidence.indptr[1:])
+        ], dtype=np.int64)
+        unique_sets = list(set_index)
 
-        for song in tqdm(self.song_ids, "Computing number of relevant songs"):
-            relevant_song_counts[song] = sum([
-                1 for other_song in self.song_ids
-                if self.is_related(song, other_song) and song != other_song
-            ])
+        set_counts = np.zeros(len(unique_sets), dtype=np.int64)
+        for i, genre_set in enumerate(tqdm(unique_sets, desc="Computing number of relevant songs")):
+            if genre_set:
+                union = np.bitwise_or.reduce(genre_bits[list(genre_set)], axis=0)
+                # The song itself is related to the union as well, but does not count
+                set_counts[i] = _popcount(union) - 1
 
-        return relevant_song_counts
+        return dict(zip(self.song_ids, set_counts[set_of_song].tolist()))
 
     def is_related(self, song_a: int, song_b: int) -> int:
         # Check whether two sets intersect and by how many elements
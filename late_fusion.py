@@ -1,5 +1,7 @@
+import warnings
+import numpy as np
 import pandas as pd
-from typing import Literal
+from typing import Literal, Optional
 
 
 class LateFusion:
@@ -58,3 +60,162 @@ class LateFusion:
             return merged_df.sort_values(by="aggregated_rank")
         else:
             raise ValueError("Invalid fusion method. Use 'score' or 'rank'.")
+
+
+FusionMethod = Literal["score", "rank", "rrf", "combmnz"]
+ScoreNormalization = Literal["none", "min-max", "z-score"]
+
+
+def normalize_scores(scores: np.ndarray, normalization: ScoreNormalization) -> np.ndarray:
+    """Normalizes each row (the result list of one query) of a (queries x k) score matrix; NaN marks padding."""
+    if normalization == "none":
+        return scores
+
+    with np.errstate(invalid="ignore", divide="ignore"), warnings.catch_warnings():
+        # Rows that only consist of padding are fine to end up as NaN
+        warnings.simplefilter("ignore", RuntimeWarning)
+        if normalization == "min-max":
+            low = np.nanmin(scores, axis=1, keepdims=True)
+            spread = np.nanmax(scores, axis=1, keepdims=True) - low
+            return np.where(spread > 0, (scores - low) / spread, 1.0)
+        elif normalization == "z-score":
+            std = np.nanstd(scores, axis=1, keepdims=True)
+            centered = scores - np.nanmean(scores, axis=1, keepdims=True)
+            return np.where(std > 0, centered / std, 0.0)
+
+    raise ValueError("Invalid score normalization. Use 'none', 'min-max' or 'z-score'.")
+
+
+def _grouped_average_rank(groups: np.ndarray, values: np.ndarray) -> np.ndarray:
+    """1-based descending rank of `values` within each group, ties get their average rank (like pandas)."""
+    order = np.lexsort((-values, groups))
+    sorted_groups, sorted_values = groups[order], values[order]
+
+    n = len(order)
+    group_start = np.flatnonzero(np.r_[True, sorted_groups[1:] != sorted_groups[:-1]])
+    position = np.arange(n) - np.repeat(group_start, np.diff(np.r_[group_start, n]))
+
+    # Runs of equal values within a group share the average of their positions
+    run_start = np.flatnonzero(
+        np.r_[True, (sorted_groups[1:] != sorted_groups[:-1]) | (sorted_values[1:] != sorted_values[:-1])]
+    )
+    run_length = np.diff(np.r_[run_start, n])
+    average_position = position[run_start] + (run_length - 1) / 2
+
+    ranks = np.empty(n, dtype=np.float64)
+    ranks[order] = np.repeat(average_position, run_length) + 1
+    return ranks
+
+
+def fuse_batch(
+        neighbours: list[np.ndarray],
+        scores: list[np.ndarray],
+        weights: list[float],
+        method: FusionMethod,
+        normalization: ScoreNormalization = "none",
+        k: Optional[int] = None,
+        rrf_k: int = 60,
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Fuses the result lists of any number of retrieval systems for a block of queries.
+
+    :param neighbours: Per system, a (queries x k_s) matrix of integer song indices, -1 marks padding.
+    :param scores: Per system, the matching (queries x k_s) similarity matrix.
+    :param method:
+        - "score": weighted sum of the (normalized) scores (CombSUM),
+        - "rank": weighted sum of the per-system ranks over the union of all result lists,
+          with missing songs tied at the bottom (like `LateFusion`). As in `LateFusion`,
+          the returned scores are the weighted score sums.
+        - "rrf": weighted reciprocal rank fusion, sum of w / (rrf_k + rank),
+        - "combmnz": weighted score sum times the number of systems that retrieved the song.
+    :param k: Length of the fused lists, defaults to the size of the largest union.
+    :return: (queries x k) fused song indices (-1 padded) and their fused scores, best first.
+    """
+    n_systems = len(neighbours)
+    n_queries = neighbours[0].shape[0]
+    weights = np.asarray(weights, dtype=np.float64)
+
+    # Flatten all (query, system, position) entries that are not padding
+    flat_query, flat_system, flat_id, flat_score, flat_position = [], [], [], [], []
+    for system, (system_neighbours, system_scores) in enumerate(zip(neighbours, scores)):
+        system_neighbours = np.asarray(system_neighbours)
+        system_scores = np.where(system_neighbours >= 0, np.asarray(system_scores, dtype=np.float64), np.nan)
+        system_scores = normalize_scores(system_scores, normalization)
+
+        query, position = np.nonzero(system_neighbours >= 0)
+        flat_query.append(query)
+        flat_system.append(np.full(len(query), system))
+        flat_id.append(system_neighbours[query, position].astype(np.int64))
+        flat_score.append(system_scores[query, position])
+        flat_position.append(position + 1)
+
+    flat_query = np.concatenate(flat_query)
+    flat_system = np.concatenate(flat_system)
+    flat_id = np.concatenate(flat_id)
+    flat_score = np.nan_to_num(np.concatenate(flat_score))
+    flat_position = np.concatenate(flat_position)
+
+    # Union of the result lists per query, identified by (query, song) keys
+    n_ids = int(flat_id.max()) + 1 if len(flat_id) else 1
+    union_keys, union_index = np.unique(flat_query * n_ids + flat_id, return_inverse=True)
+    union_query, union_id = union_keys // n_ids, union_keys % n_ids
+
+    score_matrix = np.zeros((len(union_keys), n_systems))
+    score_matrix[union_index, flat_system] = flat_score
+    weighted_scores = score_matrix @ weights
+
+    if method == "score":
+        fused = weighted_scores
+        sort_key = -fused
+    elif method == "combmnz":
+        hits = np.bincount(union_index, minlength=len(union_keys))
+        fused = weighted_scores * hits
+        sort_key = -fused
+    elif method == "rrf":
+        reciprocal_ranks = np.zeros((len(union_keys), n_systems))
+        reciprocal_ranks[union_index, flat_system] = 1.0 / (rrf_k + flat_position)
+        fused = reciprocal_ranks @ weights
+        sort_key = -fused
+    elif method == "rank":
+        aggregated_ranks = sum(
+            weights[system] * _grouped_average_rank(union_query, score_matrix[:, system])
+            for system in range(n_systems)
+        )
+        fused = weighted_scores
+        sort_key = aggregated_ranks
+    else:
+        raise ValueError("Invalid fusion method. Use 'score', 'rank', 'rrf' or 'combmnz'.")
+
+    # Order each query's union by the fused key (ties by song index) and cut it to k entries
+    order = np.lexsort((union_id, sort_key, union_query))
+    union_query, union_id, fused = union_query[order], union_id[order], fused[order]
+
+    counts = np.bincount(union_query, minlength=n_queries)
+    k = int(counts.max(initial=0)) if k is None else k
+    position = np.arange(len(order)) - np.repeat(np.cumsum(counts) - counts, counts)
+    keep = position < k
+
+    fused_neighbours = np.full((n_queries, k), -1, dtype=np.int64)
+    fused_scores = np.full((n_queries, k), np.nan)
+    fused_neighbours[union_query[keep], position[keep]] = union_id[keep]
+    fused_scores[union_query[keep], position[keep]] = fused[keep]
+    return fused_neighbours, fused_scores
+
+
+def fuse(
+        ids: list[np.ndarray],
+        scores: list[np.ndarray],
+        weights: list[float],
+        method: FusionMethod,
+        normalization: ScoreNormalization = "none",
+        k: Optional[int] = None,
+        rrf_k: int = 60,
+) -> tuple[np.ndarray, np.ndarray]:
+    """Fuses the result lists (song indices and scores) of any number of systems for a single query."""
+    fused_ids, fused_scores = fuse_batch(
+        [np.asarray(i)[None, :] for i in ids],
+        [np.asarray(s)[None, :] for s in scores],
+        weights, method, normalization, k, rrf_k,
+    )
+    valid = fused_ids[0] >= 0
+    return fused_ids[0][valid], fused_scores[0][valid]
@@ -0,0 +1,41 @@
+import threading
+from typing import Callable, Generic, TypeVar
+
+T = TypeVar("T")
+
+
+class Lazy(Generic[T]):
+    """
+    Proxy of a module-level singleton that is only created (by `factory`) on first
+    attribute access, so that importing a module does not load any data.
+    """
+
+    def __init__(self, factory: Callable[[], T]):
+        object.__setattr__(self, "_lazy_factory", factory)
+        object.__setattr__(self, "_lazy_instance", None)
+        object.__setattr__(self, "_lazy_lock", threading.RLock())
+
+    def _lazy_get(self) -> T:
+        instance = self._lazy_instance
+        if instance is None:
+            with self._lazy_lock:
+                instance = self._lazy_instance
+                if instance is None:
+                    instance = self._lazy_factory()
+                    object.__setattr__(self, "_lazy_instance", instance)
+        return instance
+
+    @property
+    def is_initialized(self) -> bool:
+        return self._lazy_instance is not None
+
+    def __getattr__(self, name: str):
+        return getattr(self._lazy_get(), name)
+
+    def __setattr__(self, name: str, value) -> None:
+        setattr(self._lazy_get(), name, value)
+
+    def __repr__(self) -> str:
+        if self._lazy_instance is None:
+            return f"<lazy {getattr(self._lazy_factory, '__name__', 'object')} (not initialized)>"
+        return repr(self._lazy_instance)
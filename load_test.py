@@ -0,0 +1,111 @@
+"""
+Load generator for `service.py`: keeps `--concurrency` keep-alive connections busy
+with random /similar (and optionally /fused) requests for `--duration` seconds and
+reports the throughput and the client-side p50/p99 latencies, followed by the
+service's own statistics.
+
+    python load_test.py [--url http://127.0.0.1:8080] [--concurrency 64] [--duration 10]
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+from urllib.parse import quote, urlsplit
+
+import numpy as np
+
+from retrieval_systems import RETRIEVAL_SYSTEM_SPECS
+from song import songs
+
+
+async def _get(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, host: str, path: str) -> tuple[int, bytes]:
+    writer.write(f"GET {path} HTTP/1.1\r\nHost: {host}\r\nConnection: keep-alive\r\n\r\n".encode("latin-1"))
+    await writer.drain()
+
+    status = int((await reader.readline()).split()[1])
+    content_length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        if name.strip().lower() == "content-length":
+            content_length = int(value)
+    return status, await reader.readexactly(content_length)
+
+
+async def _client(host: str, port: int, paths: list[str], deadline: float, latencies: list[float], errors: list[int]) -> None:
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            status, _ = await _get(reader, writer, host, random.choice(paths))
+            latencies.append(time.perf_counter() - start)
+            if status != 200:
+                errors.append(status)
+    finally:
+        writer.close()
+
+
+async def run_load_test(
+        url: str,
+        concurrency: int,
+        duration: float,
+        systems: list[str],
+        fused_ratio: float,
+        n: int,
+        n_songs: int,
+        seed: int = 42,
+) -> None:
+    rng = random.Random(seed)
+    song_ids = rng.sample(songs.info["id"].tolist(), min(n_songs, len(songs.info)))
+
+    paths = [f"/similar/{quote(rng.choice(systems))}/{quote(song_id)}?n={n}" for song_id in song_ids]
+    n_fused = int(len(paths) * fused_ratio / max(1e-9, 1 - fused_ratio))
+    paths += [
+        f"/fused/{quote(rng.choice(song_ids))}?systems={','.join(rng.sample(systems, 2))}&method=rank&n={n}"
+        for _ in range(n_fused if len(systems) >= 2 else 0)
+    ]
+
+    split = urlsplit(url)
+    host, port = split.hostname, split.port or 80
+    latencies: list[float] = []
+    errors: list[int] = []
+
+    start = time.perf_counter()
+    await asyncio.gather(*(
+        _client(host, port, paths, start + duration, latencies, errors) for _ in range(concurrency)
+    ))
+    elapsed = time.perf_counter() - start
+
+    p50, p99 = np.percentile(latencies, [50, 99]) * 1000
+    print(f"{len(latencies)} requests in {elapsed:.1f}s ({len(latencies) / elapsed:.0f} req/s), {len(errors)} errors")
+    print(f"Client latency: p50 {p50:.2f} ms, p99 {p99:.2f} ms")
+
+    reader, writer = await asyncio.open_connection(host, port)
+    _, body = await _get(reader, writer, host, "/stats")
+    writer.close()
+    print("Service statistics:")
+    print(json.dumps(json.loads(body), indent=2))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Load generator for the recommendation service")
+    parser.add_argument("--url", default="http://127.0.0.1:8080")
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--duration", type=float, default=10.0, help="Seconds")
+    parser.add_argument("--systems", default="", help="Comma-separated retrieval systems (default: all but the random baseline)")
+    parser.add_argument("--fused-ratio", type=float, default=0.1, help="Fraction of /fused requests")
+    parser.add_argument("--n", type=int, default=10)
+    parser.add_argument("--songs", type=int, default=10_000, help="Number of distinct query songs")
+    args = parser.parse_args()
+
+    systems = [name for name in args.systems.split(",") if name] or [
+        name for name in RETRIEVAL_SYSTEM_SPECS if name != "random_baseline"
+    ]
+    asyncio.run(run_load_test(args.url, args.concurrency, args.duration, systems, args.fused_ratio, args.n, args.songs))
+
+
+if __name__ == "__main__":
+    main()
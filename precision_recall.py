@@ -1,23 +1,25 @@
+import numpy as np
 import matplotlib.pyplot as plt
 import matplotlib.patches as mpatches
-from tqdm.notebook import tqdm
 from dataclasses import dataclass
 
+from evaluation import Evaluation, PrecisionRecallMetric
 from genres import Genres
-from utils import RETRIEVAL_COLOR, unpickle_or_compute
+from utils import RETRIEVAL_COLOR
 from retrieval import Retrieval, RETRIEVAL_SYSTEMS
 
 
 @dataclass
 class RetrievalEvalResult:
     n: int
-    precision_at_k: dict[int, float]
-    recall_at_k: dict[int, float]
+    # Arrays of length n + 1, indexed by k (index 0 is unused)
+    precision_at_k: np.ndarray
+    recall_at_k: np.ndarray
 
 
 class PrecisionRecall:
-    def __init__(self, genres: Genres, retrieval: Retrieval = None):
-        self._n = 100
+    def __init__(self, genres: Genres, retrieval: Retrieval = None, n: int = 100):
+        self._n = n
         self._results: dict[str, RetrievalEvalResult] = {}
 
         self._genres = genres
@@ -29,13 +31,12 @@ class PrecisionRecall:
     def compute(self) -> None:
         # calculate average precision and recall @ k across all tracks for each retrieval method
         # plot precision and recall @ k for each retrieval method
-        for ret_sys_name, ret_sys in RETRIEVAL_SYSTEMS.items():
+        evaluation = Evaluation(self._genres, [PrecisionRecallMetric(self._n)], self._ret)
+        for ret_sys_name in RETRIEVAL_SYSTEMS:
             print(f"Calculating precision and recall for {ret_sys_name}")
 
-            precision_at_k, recall_at_k = unpickle_or_compute(
-                f"precision_recall_{ret_sys_name}.pickle",
-                lambda: self._calculate_precision_recall(ret_sys, ret_sys_name)
-            )
+            results = evaluation.cached(ret_sys_name, f"precision_recall_at_{self._n}")
+            precision_at_k, recall_at_k = results["precision_recall"]
 
             self._results[ret_sys_name] = RetrievalEvalResult(
                 n=self._n,
@@ -120,40 +121,3 @@ class PrecisionRecall:
         plt.legend(loc="best")
         plt.tight_layout()
         plt.show()
-
-    def _calculate_precision_recall(self, ret_sys, ret_sys_name) -> tuple[dict[int, float], dict[int, float]]:
-        precision_at_k: dict[int, float] = {}
-        recall_at_k: dict[int, float] = {}
-
-        for song_id in tqdm(
-                self._genres.get_song_ids(),
-                desc=f"Calculating precision recall: {ret_sys_name}"
-        ):
-            n_relevant_songs = self._genres.get_relevant_song_counts(song_id)
-
-            retrieved_songs = ret_sys(self._ret, song_id)
-            retrieved_songs = [song_id for song_id, _ in retrieved_songs]
-
-            relevant_until_k = 0.0
-            for k in range(1, self._n + 1):
-                if self._genres.is_related(song_id, retrieved_songs[k - 1]):
-                    relevant_until_k += 1.0
-
-                precision_at_k[k] = precision_at_k.get(k, 0.0) + relevant_until_k / k
-
-                # Sanity check: Prevent division by 0
-                recall = recall_at_k.get(k, 0.0)
-                if n_relevant_songs:
-                    recall += relevant_until_k / n_relevant_songs
-
-                recall_at_k[k] = recall
-
-        n_songs = len(self._genres.get_song_ids())
-
-        # calculate average precision and recall @ k across all tracks
-        for k in range(1, self._n + 1):
-            precision_at_k[k] /= n_songs
-            recall_at_k[k] /= n_songs
-        
-        return precision_at_k, recall_at_k
-        
@@ -0,0 +1,4 @@
+def tqdm(*args, **kwargs):
+    """`tqdm.notebook.tqdm`, imported on first use since it pulls in IPython and ipywidgets."""
+    from tqdm.notebook import tqdm as notebook_tqdm
+    return notebook_tqdm(*args, **kwargs)
@@ -0,0 +1,162 @@
+import hashlib
+import inspect
+import io
+import json
+import os
+import pickle
+import threading
+from pathlib import Path
+from typing import Any, Callable, Optional
+
+import numpy as np
+
+# Total size (in bytes) of the cached results; the least recently used ones are evicted beyond it
+DEFAULT_RESULT_CACHE_SIZE = 256 * 1024 ** 2
+
+_MISSING = object()
+
+
+def code_version(*objects) -> str:
+    """Hash of the source code of the given modules, classes or functions."""
+    h = hashlib.blake2b(digest_size=16)
+    for obj in objects:
+        h.update(inspect.getsource(obj).encode("utf-8"))
+    return h.hexdigest()
+
+
+def _encode(value, arrays: list[np.ndarray]):
+    """JSON structure of `value`, whose arrays (and unsupported objects, pickled) are appended to `arrays`."""
+    if isinstance(value, np.ndarray) and value.dtype != object:
+        arrays.append(value)
+        return {"array": len(arrays) - 1}
+    if isinstance(value, np.generic):
+        value = value.item()
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return {"value": value}
+    if isinstance(value, (tuple, list)):
+        return {type(value).__name__: [_encode(item, arrays) for item in value]}
+    if isinstance(value, dict) and all(isinstance(key, str) for key in value):
+        return {"dict": {key: _encode(item, arrays) for key, item in value.items()}}
+
+    arrays.append(np.frombuffer(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL), dtype=np.uint8))
+    return {"pickle": len(arrays) - 1}
+
+
+def _decode(structure, arrays):
+    (kind, content), = structure.items()
+    if kind == "array":
+        return arrays[f"a{content}"]
+    if kind == "value":
+        return content
+    if kind == "tuple":
+        return tuple(_decode(item, arrays) for item in content)
+    if kind == "list":
+        return [_decode(item, arrays) for item in content]
+    if kind == "dict":
+        return {key: _decode(item, arrays) for key, item in content.items()}
+    return pickle.loads(arrays[f"a{content}"].tobytes())
+
+
+class ResultCache:
+    """
+    Content-addressed store of computed results in 'pickled_state/results/'. An entry
+    is keyed by a hash of its parameters, the fingerprints of the data it depends on
+    (e.g. a retrieval system's results or the genre data) and the version of the code
+    that computed it, so that a change of any of them leads to a recomputation of the
+    affected entries only, instead of stale results.
+
+    Entries are stored as uncompressed .npz files (arrays are not pickled); the least
+    recently used ones are evicted once the cache exceeds `max_bytes`.
+    """
+
+    def __init__(self, directory: Path = Path("pickled_state") / "results", max_bytes: int = DEFAULT_RESULT_CACHE_SIZE):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(params: Optional[dict] = None, dependencies: Optional[dict[str, str]] = None, code: str = "") -> str:
+        h = hashlib.blake2b(digest_size=16)
+        h.update(json.dumps(
+            {"params": params or {}, "dependencies": dependencies or {}, "code": code}, sort_keys=True, default=str
+        ).encode("utf-8"))
+        return h.hexdigest()
+
+    def _path(self, name: str, key: str) -> Path:
+        return self.directory / f"{name}.{key}.npz"
+
+    def load(self, name: str, key: str, default=None):
+        path = self._path(name, key)
+        try:
+            with np.load(path, allow_pickle=False) as data:
+                arrays = {file: data[file] for file in data.files}
+        except (FileNotFoundError, ValueError, OSError):
+            return default
+
+        # Hits count as a use for the eviction
+        path.touch()
+        meta = json.loads(str(arrays.pop("meta")))
+        return _decode(meta["structure"], arrays)
+
+    def store(self, name: str, key: str, value, dependencies: Optional[dict[str, str]] = None) -> None:
+        arrays: list[np.ndarray] = []
+        meta = {"name": name, "dependencies": dependencies or {}, "structure": _encode(value, arrays)}
+
+        buffer = io.BytesIO()
+        np.savez(buffer, meta=np.array(json.dumps(meta)), **{f"a{i}": array for i, array in enumerate(arrays)})
+
+        path = self._path(name, key)
+        with self._lock:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+            tmp_path.write_bytes(buffer.getbuffer())
+            tmp_path.replace(path)
+            self._evict(keep=path)
+
+    def get_or_compute(
+            self,
+            name: str,
+            compute: Callable[[], Any],
+            params: Optional[dict] = None,
+            dependencies: Optional[dict[str, str]] = None,
+            code: str = "",
+    ):
+        """The cached result of `compute()` for the given parameters, dependency fingerprints and code version."""
+        key = self.key(params, dependencies, code)
+        value = self.load(name, key, _MISSING)
+        if value is _MISSING:
+            print(f"  --> No cached result found. Computing '{name}' and caching it in '{self._path(name, key)}'")
+            value = compute()
+            self.store(name, key, value, dependencies)
+        return value
+
+    def _evict(self, keep: Optional[Path] = None) -> None:
+        entries = [(p.stat().st_mtime, p.stat().st_size, p) for p in self.directory.glob("*.npz")]
+        total = sum(size for _, size, _ in entries)
+        for _, size, p in sorted(entries, key=lambda entry: entry[0]):
+            if total <= self.max_bytes:
+                break
+            if p != keep:
+                p.unlink(missing_ok=True)
+                total -= size
+
+    def prune(self, dependencies: dict[str, str]) -> int:
+        """Deletes the entries that depend on an older version of any of the given dependencies."""
+        removed = 0
+        for p in self.directory.glob("*.npz"):
+            try:
+                with np.load(p, allow_pickle=False) as data:
+                    recorded = json.loads(str(data["meta"]))["dependencies"]
+            except (ValueError, OSError, KeyError):
+                continue
+            if any(name in recorded and recorded[name] != fingerprint for name, fingerprint in dependencies.items()):
+                p.unlink(missing_ok=True)
+                removed += 1
+        return removed
+
+    def clear(self) -> None:
+        for p in self.directory.glob("*.npz"):
+            p.unlink(missing_ok=True)
+
+
+result_cache = ResultCache()
@@ -1,71 +1,60 @@
 import json
-import time
 import threading
 from enum import IntEnum
 from pathlib import Path
-from typing import Union, Any
+from typing import Union, Any, Callable, Optional
 from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
-import pandas as pd
-from tqdm.notebook import tqdm
-from sklearn.metrics.pairwise import cosine_similarity
 
+from progress import tqdm
 from song import songs
-from datasets import datasets, LocalDataset
-from late_fusion import LateFusion
+from datasets import LocalDataset
+from late_fusion import fuse, fuse_batch
+from retrieval_cache import TopKStore, flusher, open_store
+from retrieval_systems import (
+    RETRIEVAL_SYSTEM_SPECS,
+    LateFusionSystem,
+    RandomSystem,
+    RetrievalSystemSpec,
+    cheapest_first,
+    get_spec,
+)
+from topk import DEFAULT_BLOCK_MEMORY_BUDGET, blocked_top_k, top_n_indices
+
+
+def _late_fusion(retN, query: str, spec: LateFusionSystem):
+    rows, scores = [], []
+    for ret_sys_name in spec.system_names:
+        results = RETRIEVAL_SYSTEMS[ret_sys_name](retN, query)
+
+        # Fusion works on song (row) indices; songs without information are dropped
+        system_rows = songs.rows_of([track_id for track_id, _ in results])
+        system_scores = np.array([similarity for _, similarity in results], dtype=np.float64)
+        rows.append(system_rows[system_rows >= 0])
+        scores.append(system_scores[system_rows >= 0])
+
+    fused_rows, fused_scores = fuse(rows, scores, spec.weights, spec.method, k=retN.n)
+    return [
+        [songs.info["id"].iat[row], float(score)]
+        for row, score in zip(fused_rows, fused_scores)
+    ]
 
 
 def do_late_fusion(retN, query: str) -> list[list[Union[int, Any]]]:
-    results1 = retN.top_similar_tracks(query, datasets.ef_bert_mfcc)
-    results2 = retN.top_similar_tracks(query, datasets.resnet)
-    lf = LateFusion(
-        df1=Retrieval.create_df_from_tracks(results1),
-        df2=Retrieval.create_df_from_tracks(results2),
-        df1_weight=0.5,
-        df2_weight=0.5,
-        method="rank"
-    )
-    return [
-        [
-            row["id"],
-            row["similarity"]
-        ] for idx, row in lf.df[:retN.n].iterrows()
-    ]
+    return _late_fusion(retN, query, RETRIEVAL_SYSTEM_SPECS["lf_bert_mfcc_musicnn"])
 
 
-RETRIEVAL_SYSTEMS = {
-    "random_baseline": lambda retN, query: retN.random_baseline(query),
-    # lyrics
-    "text_tf_idf": lambda retN, query: retN.top_similar_tracks(query, datasets.tf_idf),
-    "text_bert": lambda retN, query: retN.top_similar_tracks(query, datasets.lyrics_bert),
-    "text_word2vec": lambda retN, query: retN.top_similar_tracks(query, datasets.word2vec),
-
-    # audio
-    "musicnn": lambda retN, query: retN.top_similar_tracks(query, datasets.musicnn),
-    "mfcc_bow": lambda retN, query: retN.top_similar_tracks(query, datasets.mfcc_bow),
-    "mfcc_stats": lambda retN, query: retN.top_similar_tracks(query, datasets.mfcc_stats),
-    "ivec256": lambda retN, query: retN.top_similar_tracks(query, datasets.ivec256),
-    "ivec512": lambda retN, query: retN.top_similar_tracks(query, datasets.ivec512),
-    "ivec1024": lambda retN, query: retN.top_similar_tracks(query, datasets.ivec1024),
-    "blf_correlation": lambda retN, query: retN.top_similar_tracks(query, datasets.blf_correlation),
-    "blf_deltaspectral": lambda retN, query: retN.top_similar_tracks(query, datasets.blf_deltaspectral),
-    "blf_logfluc": lambda retN, query: retN.top_similar_tracks(query, datasets.blf_logfluc),
-    "blf_spectral": lambda retN, query: retN.top_similar_tracks(query, datasets.blf_spectral),
-    "blf_spectralcontrast": lambda retN, query: retN.top_similar_tracks(query, datasets.blf_spectralcontrast),
-    "blf_vardeltaspectral": lambda retN, query: retN.top_similar_tracks(query, datasets.blf_vardeltaspectral),
-
-    # video
-    "video_resnet": lambda retN, query: retN.top_similar_tracks(query, datasets.resnet),
-    "video_incp": lambda retN, query: retN.top_similar_tracks(query, datasets.incp),
-    "video_vgg19": lambda retN, query: retN.top_similar_tracks(query, datasets.vgg19),
-
-    # fusion
-    "ef_bert_musicnn": lambda retN, query: retN.top_similar_tracks(query, datasets.ef_bert_musicnn),
-    "ef_bert_mfcc": lambda retN, query: retN.top_similar_tracks(query, datasets.ef_bert_mfcc),
-
-    "lf_bert_mfcc_musicnn": do_late_fusion,
-}
+def _retrieval_function(spec: RetrievalSystemSpec) -> Callable:
+    if isinstance(spec, RandomSystem):
+        return lambda retN, query: retN.random_baseline(query)
+    if isinstance(spec, LateFusionSystem):
+        return lambda retN, query: _late_fusion(retN, query, spec)
+    # Datasets are resolved lazily, derived ones are built on first use
+    return lambda retN, query: retN.top_similar_tracks(query, spec.dataset())
+
+
+RETRIEVAL_SYSTEMS = {name: _retrieval_function(spec) for name, spec in RETRIEVAL_SYSTEM_SPECS.items()}
 
 
 class SimilarityMeasure(IntEnum):
@@ -76,7 +65,9 @@ class Retrieval:
     def __init__(self, n: int, use_cache: bool = True):
         self.n = n
 
-        self._cache = {}
+        self._use_cache = use_cache
+        self._stores: dict[str, TopKStore] = {}
+        self._store_song_rows: dict[int, np.ndarray] = {}
         self._cache_lock = threading.Lock()
 
         self._cache_dir = Path("retrievals")
@@ -85,43 +76,81 @@ class Retrieval:
         if use_cache:
             self.sync_cache_with_disk()
 
-    def sync_cache_with_disk(self):
-        cache_was_empty = len(self._cache) == 0
+    def _store(self, dataset: LocalDataset) -> TopKStore:
+        # Must be called while holding the cache lock
+        store = self._stores.get(dataset.name)
+        if store is None:
+            directory = self._cache_dir / dataset.name
+            if self._use_cache:
+                if not TopKStore.exists(directory):
+                    self._migrate_json_cache(dataset)
+                store = open_store(directory, fingerprint=dataset.fingerprint)
+            else:
+                store = TopKStore(directory, persistent=False, fingerprint=dataset.fingerprint)
+
+            # The dataset ids are only needed (and loaded) for a new store
+            if store.n_rows == 0:
+                store.rows_for(dataset.ids)
+            self._stores[dataset.name] = store
+        return store
+
+    def _migrate_json_cache(self, dataset: LocalDataset) -> None:
+        json_path = self._cache_dir / f"{dataset.name}.json"
+        if json_path.exists():
+            print(f"Converting legacy cache file '{json_path}' to the binary cache format")
+            TopKStore.from_json_file(json_path, self._cache_dir / dataset.name, fingerprint=dataset.fingerprint)
 
+    def sync_cache_with_disk(self):
         with self._cache_lock:
-            for p in self._cache_dir.iterdir():
-                try:
-                    if p.name == "songMeta" or p.suffix != ".json":
-                        continue
-
-                    if p.stem == "songMeta":
-                        continue
+            stores = list(self._stores.items())
 
-                    with p.open() as fp:
-                        old_cache = json.load(fp)
+        for name, store in stores:
+            try:
+                store.flush()
+            except Exception as e:
+                print(f"Error syncing cache for '{name}' with disk: {e}")
 
-                    dataset_name = p.stem
-                    if dataset_name not in self._cache:
-                        self._cache[dataset_name] = {}
+    def compact_cache(self):
+        """Merges the append-only logs of all retrieval caches into their snapshots."""
+        with self._cache_lock:
+            stores = list(self._stores.values())
 
-                    self._cache[dataset_name].update(old_cache)
-                except Exception as e:
-                    print(f"Error syncing cache for '{p.name}' with disk: {e}")
+        for store in stores:
+            store.compact()
 
-            if not cache_was_empty:
-                for dataset_name in self._cache:
-                    with (self._cache_dir / (dataset_name + ".json")).open("w") as fp:
-                        json.dump(self._cache[dataset_name], fp)
+    def export_json(self, directory: Path) -> None:
+        """Writes every cached retrieval system as `<name>.json` in the legacy format (e.g. for the frontend)."""
+        directory.mkdir(parents=True, exist_ok=True)
+        with self._cache_lock:
+            for p in self._cache_dir.iterdir():
+                if not TopKStore.exists(p):
+                    continue
+                store = open_store(p)
+                with (directory / f"{p.name}.json").open("w") as fp:
+                    json.dump(store.to_json_dict(), fp)
 
-    def precompute_all(self, threads: int):
+    def precompute_all(self, threads: int, memory_budget: int = DEFAULT_BLOCK_MEMORY_BUDGET):
         self.sync_cache_with_disk()
 
+        # Dataset-backed systems are computed as blocked matrix products, which are
+        # already parallelized by BLAS. Only the remaining systems use the thread pool.
+        # Cheap systems go first, so that their results are available early on.
+        for retrieval in cheapest_first(RETRIEVAL_SYSTEMS):
+            if get_spec(retrieval).dataset_backed:
+                self.precompute(retrieval, memory_budget=memory_budget)
+
         with ThreadPoolExecutor(max_workers=threads) as executor:
-            for retrieval in RETRIEVAL_SYSTEMS:
-                if retrieval != "random_baseline":
+            for retrieval in cheapest_first(RETRIEVAL_SYSTEMS):
+                if isinstance(get_spec(retrieval), LateFusionSystem):
                     executor.submit(self.precompute, retrieval)
 
-    def precompute(self, retrieval):
+    def precompute(self, retrieval, memory_budget: int = DEFAULT_BLOCK_MEMORY_BUDGET):
+        spec = get_spec(retrieval)
+        if spec.dataset_backed:
+            self.precompute_dataset(spec.dataset(), memory_budget=memory_budget)
+            print(f"Precomputed results for: '{retrieval}'")
+            return
+
         ret_sys = RETRIEVAL_SYSTEMS[retrieval]
         for idx, song_id in tqdm(
             enumerate(songs.info["id"]),
@@ -136,6 +165,130 @@ class Retrieval:
         print(f"Precomputed results for: '{retrieval}'")
         self.sync_cache_with_disk()
 
+    def precompute_dataset(self, dataset: LocalDataset, memory_budget: int = DEFAULT_BLOCK_MEMORY_BUDGET):
+        """
+        Computes the top-n tracks of every song in `dataset` in blocks of queries,
+        where the similarities of one block take up at most `memory_budget` bytes.
+        """
+        with self._cache_lock:
+            store = self._store(dataset)
+
+        # Translates dataset rows to rows of the store's id table
+        store_rows = store.rows_for(dataset.ids)
+        query_rows = np.array([
+            row for row, store_row in enumerate(store_rows.tolist())
+            if store.depth(store_row) < self.n
+        ], dtype=np.intp)
+
+        blocks = blocked_top_k(dataset.matrix, self.n, query_rows, memory_budget=memory_budget)
+        with tqdm(
+            total=len(query_rows),
+            desc=f"Precomputing top-{self.n} tracks for dataset '{dataset.name}'",
+        ) as progress:
+            for rows, neighbours, similarities in blocks:
+                store.put(store_rows[rows], store_rows[neighbours], similarities)
+                # Finished blocks are persisted in the background, so a killed run resumes from there
+                flusher.notify(store)
+                progress.update(len(rows))
+
+        store.compact()
+
+    def top_k_arrays(self, ret_sys_name: str, query_ids=None) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Top-n results of `ret_sys_name` for many queries (default: all songs) at once.
+
+        :return: (queries x n) matrices of the retrieved songs as row indices into
+            `songs.info` (-1 where there is no result) and their similarities.
+        """
+        if query_ids is None:
+            query_ids = songs.info["id"].to_numpy()
+
+        spec = get_spec(ret_sys_name)
+        if spec.dataset_backed:
+            dataset = spec.dataset()
+            self.precompute_dataset(dataset)
+            return self._dataset_top_k(dataset, query_ids)
+
+        if isinstance(spec, LateFusionSystem):
+            inputs = [self.top_k_arrays(name, query_ids) for name in spec.system_names]
+            return fuse_batch(
+                [neighbours for neighbours, _ in inputs],
+                [scores for _, scores in inputs],
+                spec.weights, spec.method, k=self.n,
+            )
+
+        return self.random_baseline_arrays(query_ids)
+
+    def top_k_batch(self, ret_sys_name: str, query_ids) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Same as `top_k_arrays` for a (small) batch of queries, e.g. of concurrent
+        requests: cached results are read from the store, and only the uncached queries
+        are computed, in one matrix product. Unknown songs get rows of -1.
+        """
+        spec = get_spec(ret_sys_name)
+        if spec.dataset_backed:
+            return self._dataset_top_k(spec.dataset(), query_ids)
+
+        if isinstance(spec, LateFusionSystem):
+            inputs = [self.top_k_batch(name, query_ids) for name in spec.system_names]
+            return fuse_batch(
+                [neighbours for neighbours, _ in inputs],
+                [scores for _, scores in inputs],
+                spec.weights, spec.method, k=self.n,
+            )
+
+        return self.random_baseline_arrays(query_ids)
+
+    def cached_depth(self, ret_sys_name: str) -> Optional[int]:
+        """Largest n any query of a dataset-backed system is cached for (None for the other systems)."""
+        spec = get_spec(ret_sys_name)
+        if not spec.dataset_backed:
+            return None
+        with self._cache_lock:
+            return self._store(spec.dataset()).stored_depth
+
+    def _dataset_top_k(self, dataset: LocalDataset, query_ids) -> tuple[np.ndarray, np.ndarray]:
+        with self._cache_lock:
+            store = self._store(dataset)
+        neighbours, scores = store.get_block(query_ids, self.n)
+
+        # Queries of the dataset without (enough) cached results
+        id_to_row = dataset.id_to_row
+        missing = [i for i in np.flatnonzero(neighbours[:, 0] < 0).tolist() if query_ids[i] in id_to_row]
+        if missing:
+            store_rows = store.rows_for(dataset.ids)
+            query_rows = np.array([id_to_row[query_ids[i]] for i in missing], dtype=np.intp)
+            for rows, block_neighbours, similarities in blocked_top_k(dataset.matrix, self.n, query_rows):
+                store.put(store_rows[rows], store_rows[block_neighbours], similarities)
+            flusher.notify(store)
+            neighbours[missing], scores[missing] = store.get_block([query_ids[i] for i in missing], self.n)
+
+        # Translate rows of the store's id table into rows of the information table
+        neighbours = np.where(neighbours >= 0, self._song_rows_of_store(store)[neighbours], -1)
+        return neighbours, scores.astype(np.float64)
+
+    def _song_rows_of_store(self, store: TopKStore) -> np.ndarray:
+        """Rows of the information table for all rows of the store's id table (cached until new ids are added)."""
+        with self._cache_lock:
+            song_rows = self._store_song_rows.get(id(store))
+            if song_rows is None or len(song_rows) != store.n_rows:
+                song_rows = songs.rows_of(store.ids_of(np.arange(store.n_rows)))
+                self._store_song_rows[id(store)] = song_rows
+            return song_rows
+
+    def random_baseline_arrays(self, query_ids, seed: Optional[int] = None) -> tuple[np.ndarray, np.ndarray]:
+        """Vectorized `random_baseline`: n random songs (without the query itself) per query."""
+        rng = np.random.default_rng(seed)
+        n_songs = len(songs.info)
+        query_rows = songs.rows_of(query_ids)
+
+        neighbours = np.empty((len(query_rows), self.n), dtype=np.int64)
+        for i, query_row in enumerate(query_rows):
+            sample = rng.choice(n_songs - 1, size=self.n, replace=False)
+            # Skip over the query song itself
+            neighbours[i] = sample + (sample >= query_row) if query_row >= 0 else sample
+        return neighbours, np.ones(neighbours.shape)
+
     def random_baseline(self, song_id) -> list[list[Union[int, Any]]]:
         # Exclude the query song from the dataset (if it exists)
         # and select N random songs from the filtered data
@@ -143,72 +296,73 @@ class Retrieval:
         return [[id, 1] for id in random_results["id"].values]
 
     def top_similar_tracks(self, query_track_id, dataset: LocalDataset):
+        # Approximate results are cheap to recompute and must not end up in the exact cache
+        if dataset.ann_index is not None:
+            return self._top_similar_tracks(query_track_id, dataset)
+
         with self._cache_lock:
-            if dataset.name not in self._cache:
-                self._cache[dataset.name] = {}
+            store = self._store(dataset)
 
-            if query_track_id in self._cache[dataset.name]:
-                cached = self._cache[dataset.name][query_track_id][:self.n]
-                # only return cached if it is the same length as n
-                if len(cached) == self.n:
-                    return cached
+        # Any n up to the stored depth of the query is served by slicing; a deeper
+        # request is computed below and replaces the shallower cached result.
+        cached = store.get(query_track_id, self.n)
+        if cached is not None:
+            return cached
 
         result = self._top_similar_tracks(query_track_id, dataset)
-        with self._cache_lock:
-            self._cache[dataset.name][query_track_id] = result
+
+        neighbour_ids, similarities = zip(*result) if result else ((), ())
+        store.put(
+            store.rows_for([query_track_id]),
+            store.rows_for(neighbour_ids)[None, :],
+            np.array([similarities], dtype=np.float32),
+        )
+        flusher.notify(store)
 
         return result
 
     # Function to retrieve top N similar tracks
     def _top_similar_tracks(self, query_track_id, dataset: LocalDataset):
-        start_time = time.time()
-        features_data = dataset.df if isinstance(dataset, LocalDataset) else dataset
-        if query_track_id not in features_data['id'].values:
-            # print(f"Track ID {query_track_id} not found in the data.")
-            raise ValueError(f"Track ID {query_track_id} not found in the data.")
-        
-        query_track_features = features_data[
-            features_data['id'] == query_track_id
-        ].iloc[:, features_data.columns != "id"].values
-
-        # Calculate similarity with the given features
-        similarity_matrix = cosine_similarity(
-            query_track_features,
-            features_data.iloc[:, features_data.columns != "id"].values
-        )
+        if not isinstance(dataset, LocalDataset):
+            dataset = LocalDataset("<DataFrame>", dataset)
+
+        query_row = dataset.row_of(query_track_id)
+        features = dataset.matrix
+
+        if dataset.ann_index is not None:
+            top_indices, similarities = dataset.ann_index.search(
+                features, features[query_row], self.n, exclude_row=query_row
+            )
+            return [
+                [dataset.ids[track_index], float(similarity)]
+                for track_index, similarity in zip(top_indices, similarities)
+            ]
 
-        # Get the indices of the top N similar tracks
-        # similarity 1 = the song itself, hence it should not be returned
-        top_indices = np.argsort(similarity_matrix[0])[-(self.n+1):-1][::-1]
+        # Rows are L2-normalized, so a single mat-vec yields the cosine similarities
+        similarities = features @ features[query_row]
 
-        # Create a list to store rows
-        result_rows = []
+        # The query song itself should not be returned
+        similarities[query_row] = -np.inf
 
-        # Populate the list with song and artist information
-        for track_index in top_indices:
-            track_id = features_data.iat[track_index, features_data.columns.get_loc('id')]
-            similarity = similarity_matrix[0][track_index]
-            result_rows.append([track_id, similarity])
+        top_indices = top_n_indices(similarities, self.n)
 
-        return result_rows
+        return [
+            [dataset.ids[track_index], float(similarities[track_index])]
+            for track_index in top_indices
+        ]
 
     @staticmethod
     def create_df_from_tracks(tracks):
-        result_rows = []
-        for [track_id, similarity] in tracks:
-            info_row = songs.info[songs.info['id'] == track_id]
-            if not info_row.empty:
-                artist = info_row['artist'].values[0]
-                song = info_row['song'].values[0]
-                album_name = info_row['album_name'].values[0]
-                result_rows.append({
-                    'id': track_id,
-                    'similarity': similarity,
-                    'song': song,
-                    'artist': artist,
-                    'album_name': album_name,
-                })
-        result_df = pd.DataFrame(result_rows)
+        track_ids = [track_id for track_id, _ in tracks]
+        similarities = np.array([similarity for _, similarity in tracks], dtype=np.float64)
+
+        # One indexed take instead of a scan of the information table per track
+        rows = songs.rows_of(track_ids)
+        found = rows >= 0
+
+        result_df = songs.info.iloc[rows[found]][["id", "song", "artist", "album_name"]].reset_index(drop=True)
+        result_df.insert(1, "similarity", similarities[found])
+
         # Sort the DataFrame based on "Similarity" column
         result_df = result_df.sort_values(by='similarity', ascending=False)
         return result_df
@@ -0,0 +1,435 @@
+import json
+import os
+import struct
+import threading
+import time
+import zlib
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+
+# Log record header: record type, two int32 fields and the crc32 of the payload
+_RECORD_HEADER = struct.Struct("<BiiI")
+_RECORD_IDS = 1
+_RECORD_RESULT = 2
+
+
+class TopKStore:
+    """
+    Binary, memory-mappable top-k results of a single retrieval system.
+
+    A store lives in its own directory and consists of a snapshot generation ``g``:
+      - ``ids.<g>.npy``: the id table, i.e. the song id of every row,
+      - ``neighbours.<g>.npy``: (n_rows x k) int32 neighbour rows into the id table,
+      - ``scores.<g>.npy``: (n_rows x k) float32 similarities of those neighbours,
+      - ``depth.<g>.npy``: int32 number of valid neighbours per row (0 = not computed),
+    plus an append-only log ``log.<g>.bin`` with everything stored after the snapshot
+    was written, and ``manifest.json`` which names the current generation, the stored
+    depth k and the fingerprint of the data (features and build parameters) the
+    results were computed from.
+
+    Every row keeps its own depth, so any n up to the stored depth of a query is
+    served by slicing, and a deeper result simply replaces a shallower one.
+    A store whose fingerprint does not match the current data is discarded.
+
+    The snapshot arrays are opened with ``mmap_mode="r"``, so opening a store is
+    constant time and cached results are served straight from the mapped files.
+    :meth:`flush` only appends new results to the log; :meth:`compact` merges the log
+    into a new snapshot generation and switches to it with an atomic rename of the
+    manifest. A partially written log record (e.g. of a killed process) is dropped
+    when the log is replayed, so all results up to the last flush survive a crash.
+    """
+
+    def __init__(self, directory: Path, persistent: bool = True, fingerprint: Optional[str] = None):
+        self.directory = directory
+        self.fingerprint = fingerprint
+
+        self._lock = threading.RLock()
+        self._generation = 0
+
+        self._ids: np.ndarray = np.empty(0, dtype="<U1")
+        self._neighbours: np.ndarray = np.empty((0, 0), dtype=np.int32)
+        self._scores: np.ndarray = np.empty((0, 0), dtype=np.float32)
+        self._depth: np.ndarray = np.empty(0, dtype=np.int32)
+        self._id_to_row: Optional[dict[str, int]] = None
+
+        # Ids and results that are not part of the snapshot (but may be in the log)
+        self._new_ids: list[str] = []
+        self._pending: dict[int, tuple[np.ndarray, np.ndarray]] = {}
+        # Encoded log records that have not been written yet
+        self._log_buffer: list[bytes] = []
+
+        # A non-persistent store only keeps its results in memory
+        self.persistent = persistent
+
+        if persistent and self.exists(directory):
+            self._open()
+            if fingerprint is None or self.fingerprint == fingerprint:
+                self._replay_log()
+            else:
+                self.invalidate(fingerprint)
+
+    @staticmethod
+    def exists(directory: Path) -> bool:
+        return (directory / "manifest.json").exists()
+
+    def _path(self, name: str, generation: Optional[int] = None) -> Path:
+        generation = self._generation if generation is None else generation
+        return self.directory / f"{name}.{generation}.{'bin' if name == 'log' else 'npy'}"
+
+    def _open(self) -> None:
+        with (self.directory / "manifest.json").open() as fp:
+            manifest = json.load(fp)
+        self._generation = manifest["generation"]
+        self.fingerprint = manifest.get("fingerprint")
+
+        self._ids = np.load(self._path("ids"), mmap_mode="r")
+        self._neighbours = np.load(self._path("neighbours"), mmap_mode="r")
+        self._scores = np.load(self._path("scores"), mmap_mode="r")
+        self._depth = np.load(self._path("depth"), mmap_mode="r")
+        self._id_to_row = None
+
+    def _replay_log(self) -> None:
+        log_path = self._path("log")
+        if not log_path.exists():
+            return
+
+        data = log_path.read_bytes()
+        offset = 0
+        while offset + _RECORD_HEADER.size <= len(data):
+            record_type, a, b, crc = _RECORD_HEADER.unpack_from(data, offset)
+            payload_size = b if record_type == _RECORD_IDS else 8 * b
+            payload = data[offset + _RECORD_HEADER.size:offset + _RECORD_HEADER.size + payload_size]
+            if len(payload) != payload_size or zlib.crc32(payload) != crc:
+                break
+
+            if record_type == _RECORD_IDS:
+                ids = payload.decode("utf-8").split("\n")
+                # Ids that are already part of the id table are skipped
+                self._append_ids(ids[max(0, self.n_rows - a):])
+            elif record_type == _RECORD_RESULT:
+                self._pending[a] = (
+                    np.frombuffer(payload, dtype=np.int32, count=b),
+                    np.frombuffer(payload, dtype=np.float32, count=b, offset=4 * b),
+                )
+            offset += _RECORD_HEADER.size + payload_size
+
+        if offset != len(data):
+            print(f"Dropping {len(data) - offset} bytes of incomplete records from '{log_path}'")
+            with log_path.open("r+b") as fp:
+                fp.truncate(offset)
+
+    def invalidate(self, fingerprint: Optional[str]) -> None:
+        """Drops all stored results, e.g. because the data they were computed from changed."""
+        with self._lock:
+            print(f"Discarding stale retrieval cache '{self.directory}' (fingerprint changed)")
+            for p in self.directory.glob("*"):
+                p.unlink()
+
+            self.fingerprint = fingerprint
+            self._generation = 0
+            self._ids = np.empty(0, dtype="<U1")
+            self._neighbours = np.empty((0, 0), dtype=np.int32)
+            self._scores = np.empty((0, 0), dtype=np.float32)
+            self._depth = np.empty(0, dtype=np.int32)
+            self._id_to_row = None
+            self._new_ids = []
+            self._pending = {}
+            self._log_buffer = []
+
+    @property
+    def stored_depth(self) -> int:
+        """The stored depth k, i.e. the largest number of neighbours stored for any query."""
+        with self._lock:
+            return max([self._neighbours.shape[1]] + [len(n) for n, _ in self._pending.values()])
+
+    @property
+    def n_rows(self) -> int:
+        return len(self._ids) + len(self._new_ids)
+
+    @property
+    def id_to_row(self) -> dict[str, int]:
+        if self._id_to_row is None:
+            self._id_to_row = {song_id: row for row, song_id in enumerate(self._ids.tolist())}
+            self._id_to_row.update({song_id: len(self._ids) + i for i, song_id in enumerate(self._new_ids)})
+        return self._id_to_row
+
+    def id_of(self, row: int) -> str:
+        return str(self._ids[row]) if row < len(self._ids) else self._new_ids[row - len(self._ids)]
+
+    def ids_of(self, rows: np.ndarray) -> np.ndarray:
+        if not self._new_ids:
+            return self._ids[rows]
+        return np.array([self.id_of(row) for row in rows.tolist()])
+
+    def _append_ids(self, ids: list[str]) -> None:
+        id_to_row = self.id_to_row
+        for song_id in ids:
+            id_to_row[song_id] = self.n_rows
+            self._new_ids.append(song_id)
+
+    def rows_for(self, ids) -> np.ndarray:
+        """Rows of `ids` in the id table; unknown ids are appended to it."""
+        with self._lock:
+            id_to_row = self.id_to_row
+            new_ids = list(dict.fromkeys(song_id for song_id in ids if song_id not in id_to_row))
+            if new_ids and self.persistent:
+                payload = "\n".join(new_ids).encode("utf-8")
+                self._log_buffer.append(
+                    _RECORD_HEADER.pack(_RECORD_IDS, self.n_rows, len(payload), zlib.crc32(payload)) + payload
+                )
+            self._append_ids(new_ids)
+
+            return np.array([id_to_row[song_id] for song_id in ids], dtype=np.int32)
+
+    def depth(self, row: int) -> int:
+        with self._lock:
+            if row in self._pending:
+                return len(self._pending[row][0])
+            return int(self._depth[row]) if row < len(self._depth) else 0
+
+    def get_rows(self, song_id: str, n: int) -> Optional[tuple[np.ndarray, np.ndarray]]:
+        """Neighbour rows and scores of `song_id`, or None if fewer than `n` are stored."""
+        with self._lock:
+            row = self.id_to_row.get(song_id)
+            if row is None or self.depth(row) < n:
+                return None
+
+            if row in self._pending:
+                neighbours, scores = self._pending[row]
+            else:
+                neighbours, scores = self._neighbours[row], self._scores[row]
+            return neighbours[:n], scores[:n]
+
+    def get_block(self, song_ids, n: int) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Neighbour rows and scores of many queries at once as (queries x n) matrices.
+        Queries with fewer than `n` stored neighbours get rows of -1 (and NaN scores).
+        """
+        with self._lock:
+            id_to_row = self.id_to_row
+            rows = np.fromiter((id_to_row.get(song_id, -1) for song_id in song_ids), dtype=np.int64, count=len(song_ids))
+
+            neighbours = np.full((len(rows), n), -1, dtype=np.int32)
+            scores = np.full((len(rows), n), np.nan, dtype=np.float32)
+
+            # Only rows with at least n stored neighbours are served, which a snapshot
+            # shallower than n (e.g. of an empty store) has none of
+            in_snapshot = (rows >= 0) & (rows < len(self._depth)) & (self._neighbours.shape[1] >= n)
+            in_snapshot[in_snapshot] = self._depth[rows[in_snapshot]] >= n
+            is_pending = np.isin(rows, list(self._pending)) if self._pending else np.zeros(len(rows), dtype=bool)
+            in_snapshot &= ~is_pending
+            if in_snapshot.any():
+                neighbours[in_snapshot] = self._neighbours[rows[in_snapshot], :n]
+                scores[in_snapshot] = self._scores[rows[in_snapshot], :n]
+
+            for i in np.flatnonzero(is_pending):
+                row_neighbours, row_scores = self._pending[rows[i]]
+                if len(row_neighbours) >= n:
+                    neighbours[i], scores[i] = row_neighbours[:n], row_scores[:n]
+
+            return neighbours, scores
+
+    def get(self, song_id: str, n: int) -> Optional[list[list]]:
+        with self._lock:
+            result = self.get_rows(song_id, n)
+            if result is None:
+                return None
+
+            neighbours, scores = result
+            return [list(pair) for pair in zip(self.ids_of(neighbours).tolist(), scores.tolist())]
+
+    def put(self, query_rows: np.ndarray, neighbours: np.ndarray, scores: np.ndarray) -> None:
+        """Stores the neighbours (rows into the id table) and scores of a block of queries."""
+        with self._lock:
+            for row, row_neighbours, row_scores in zip(query_rows.tolist(), neighbours, scores):
+                row_neighbours = np.ascontiguousarray(row_neighbours, dtype=np.int32)
+                row_scores = np.ascontiguousarray(row_scores, dtype=np.float32)
+                self._pending[row] = (row_neighbours, row_scores)
+                if not self.persistent:
+                    continue
+
+                payload = row_neighbours.tobytes() + row_scores.tobytes()
+                self._log_buffer.append(
+                    _RECORD_HEADER.pack(_RECORD_RESULT, row, len(row_neighbours), zlib.crc32(payload)) + payload
+                )
+
+    def flush(self) -> None:
+        """Appends all results stored since the last flush to the log."""
+        with self._lock:
+            if not self.persistent or not self._log_buffer:
+                return
+
+            if not self.exists(self.directory):
+                # The first snapshot of a new store is empty, everything else goes into its log
+                self._write_snapshot(self._generation, [], np.empty((0, 0)), np.empty((0, 0)), np.empty(0))
+
+            with self._path("log").open("ab") as fp:
+                fp.write(b"".join(self._log_buffer))
+                fp.flush()
+                os.fsync(fp.fileno())
+            self._log_buffer = []
+
+    def compact(self) -> None:
+        """Merges the snapshot and the log into a new snapshot generation."""
+        with self._lock:
+            if not self.persistent:
+                return
+            # Nothing to merge: the store stays read-only, e.g. for concurrent readers in other processes
+            if not self._new_ids and not self._pending and self.exists(self.directory):
+                return
+
+            n_rows = self.n_rows
+            depth = self.stored_depth
+
+            all_ids = np.concatenate([np.asarray(self._ids, dtype=str), np.array(self._new_ids, dtype=str)])
+            neighbours = np.full((n_rows, depth), -1, dtype=np.int32)
+            scores = np.full((n_rows, depth), np.nan, dtype=np.float32)
+            depths = np.zeros(n_rows, dtype=np.int32)
+
+            old_rows, old_depth = self._neighbours.shape
+            neighbours[:old_rows, :old_depth] = self._neighbours
+            scores[:old_rows, :old_depth] = self._scores
+            depths[:len(self._depth)] = self._depth
+
+            for row, (row_neighbours, row_scores) in self._pending.items():
+                neighbours[row] = -1
+                scores[row] = np.nan
+                neighbours[row, :len(row_neighbours)] = row_neighbours
+                scores[row, :len(row_scores)] = row_scores
+                depths[row] = len(row_neighbours)
+
+            old_generation = self._generation
+            self._write_snapshot(old_generation + 1, all_ids, neighbours, scores, depths)
+
+            # The new generation is live, the old snapshot and its log can go
+            for name in ("ids", "neighbours", "scores", "depth", "log"):
+                self._path(name, old_generation).unlink(missing_ok=True)
+
+            self._new_ids = []
+            self._pending = {}
+            self._log_buffer = []
+            self._open()
+
+    def _write_snapshot(self, generation: int, ids, neighbours, scores, depths) -> None:
+        self.directory.mkdir(parents=True, exist_ok=True)
+        for name, array, dtype in (
+                ("ids", ids, str),
+                ("neighbours", neighbours, np.int32),
+                ("scores", scores, np.float32),
+                ("depth", depths, np.int32),
+        ):
+            _save_atomic(self._path(name, generation), np.asarray(array, dtype=dtype))
+
+        # Switching the manifest atomically makes the new generation visible
+        _write_json_atomic(self.directory / "manifest.json", {
+            "generation": generation,
+            "depth": int(np.shape(neighbours)[1]) if np.ndim(neighbours) == 2 else 0,
+            "fingerprint": self.fingerprint,
+        })
+        self._generation = generation
+
+    def to_json_dict(self) -> dict[str, list[list]]:
+        """Results in the legacy `{query_id: [[id, similarity], ...]}` format (used by the frontend)."""
+        with self._lock:
+            result = {}
+            for row in range(self.n_rows):
+                depth = self.depth(row)
+                if depth:
+                    result[self.id_of(row)] = self.get(self.id_of(row), depth)
+            return result
+
+    @classmethod
+    def from_json_file(cls, path: Path, directory: Path, fingerprint: Optional[str] = None) -> "TopKStore":
+        """
+        Converts a legacy `retrievals/<name>.json` cache file into a store. Legacy files
+        do not record what they were computed from, so they are assumed to be up to date.
+        """
+        with path.open() as fp:
+            cache = json.load(fp)
+
+        store = cls(directory, fingerprint=fingerprint)
+        for query_id, results in cache.items():
+            if not results:
+                continue
+            neighbour_ids, scores = zip(*results)
+            store.put(store.rows_for([query_id]), store.rows_for(neighbour_ids)[None, :], np.array([scores]))
+        store.compact()
+        return store
+
+
+class CacheFlusher:
+    """
+    Background thread that appends the new results of all registered stores to their logs.
+    Having a single writer means concurrent retrievals never write the same files at once.
+    """
+
+    def __init__(self, interval: float = 1.0):
+        self.interval = interval
+
+        self._stores: set[TopKStore] = set()
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    def notify(self, store: TopKStore) -> None:
+        with self._lock:
+            self._stores.add(store)
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="retrieval-cache-flusher", daemon=True)
+                self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            time.sleep(self.interval)
+            self.flush()
+
+    def flush(self) -> None:
+        with self._lock:
+            stores = list(self._stores)
+
+        for store in stores:
+            try:
+                store.flush()
+            except Exception as e:
+                print(f"Error flushing retrieval cache '{store.directory}': {e}")
+
+
+# Stores are shared per directory, so that the flusher is the only writer of their files
+_stores: dict[Path, TopKStore] = {}
+_stores_lock = threading.Lock()
+
+flusher = CacheFlusher()
+
+
+def open_store(directory: Path, fingerprint: Optional[str] = None) -> TopKStore:
+    """
+    Returns the shared store in `directory`. If a `fingerprint` is given, results
+    computed from different data are discarded.
+    """
+    with _stores_lock:
+        directory = directory.resolve()
+        store = _stores.get(directory)
+        if store is None:
+            store = _stores[directory] = TopKStore(directory, fingerprint=fingerprint)
+        elif fingerprint is not None and store.fingerprint != fingerprint:
+            store.invalidate(fingerprint)
+        return store
+
+
+def _save_atomic(path: Path, array: np.ndarray) -> None:
+    tmp_path = path.with_name(path.name + ".tmp")
+    with tmp_path.open("wb") as fp:
+        np.save(fp, array)
+        fp.flush()
+        os.fsync(fp.fileno())
+    os.replace(tmp_path, path)
+
+
+def _write_json_atomic(path: Path, data) -> None:
+    tmp_path = path.with_name(path.name + ".tmp")
+    with tmp_path.open("w") as fp:
+        json.dump(data, fp)
+        fp.flush()
+        os.fsync(fp.fileno())
+    os.replace(tmp_path, path)
@@ -0,0 +1,258 @@
+import hashlib
+import json
+import threading
+from dataclasses import dataclass
+from typing import Optional, Union
+
+import numpy as np
+import pandas as pd
+
+from datasets import datasets, LocalDataset
+from early_fusion import EarlyFusion, PcaMethod
+import late_fusion
+from late_fusion import FusionMethod
+from result_cache import code_version
+
+# Serializes building derived datasets, so that concurrent retrievals build them only once
+_build_lock = threading.RLock()
+
+
+def _hash(*parts) -> str:
+    return hashlib.blake2b(json.dumps(parts).encode("utf-8"), digest_size=16).hexdigest()
+
+
+@dataclass(frozen=True)
+class DatasetSystem:
+    """Cosine top-k search over a raw dataset, given by its attribute name on `datasets`."""
+    name: str
+    dataset_name: str
+
+    # Whether the system is a cosine top-k search over `dataset()`
+    dataset_backed = True
+
+    @property
+    def inputs(self) -> tuple[str, ...]:
+        return ()
+
+    def dataset(self) -> LocalDataset:
+        return getattr(datasets, self.dataset_name)
+
+    def build(self) -> None:
+        # Raw datasets are converted into binary snapshots, so that workers memory-map them
+        self.dataset().build_snapshot()
+
+    def fingerprint(self) -> str:
+        """Changes whenever the results of the system may change (see `LocalDataset.fingerprint`)."""
+        return self.dataset().fingerprint
+
+    def memory_footprint(self) -> int:
+        """Bytes taken up by the features and the normalized matrix while retrieving."""
+        n_rows, n_cols = self.dataset().shape
+        return 2 * 4 * n_rows * n_cols
+
+    def build_cost(self) -> float:
+        """Estimated floating point operations to compute the top-k lists of all songs."""
+        n_rows, n_cols = self.dataset().shape
+        return 2.0 * n_rows * n_rows * n_cols
+
+
+@dataclass(frozen=True)
+class EarlyFusionSystem:
+    """Cosine top-k search over the concatenated PCA projections of two raw datasets (see `EarlyFusion`)."""
+    name: str
+    dataset_names: tuple[str, str]
+    n_components: float = 0.5
+    method: PcaMethod = "auto"
+
+    dataset_backed = True
+
+    @property
+    def inputs(self) -> tuple[str, ...]:
+        return self.dataset_names
+
+    def _input_datasets(self) -> tuple[LocalDataset, LocalDataset]:
+        d1, d2 = (getattr(datasets, name) for name in self.dataset_names)
+        return d1, d2
+
+    def dataset(self) -> LocalDataset:
+        """
+        The fused dataset, which is attached to `datasets` under this system's name on
+        first use. Its PCA result is persisted, so later processes only memory-map it.
+        """
+        with _build_lock:
+            dataset = getattr(datasets, self.name, None)
+            if dataset is None:
+                d1, d2 = self._input_datasets()
+                early_fusion = EarlyFusion(d1, d2, self.n_components, method=self.method)
+                dataset = early_fusion.to_dataset(self.name)
+                setattr(datasets, self.name, dataset)
+            return dataset
+
+    def build(self) -> None:
+        self.dataset()
+
+    def fingerprint(self) -> str:
+        dataset = getattr(datasets, self.name, None)
+        if dataset is None:
+            # A persisted fusion is not loaded just to check for cached results
+            d1, d2 = self._input_datasets()
+            fingerprint = EarlyFusion.persisted_fingerprint(d1, d2, self.n_components, method=self.method)
+            if fingerprint is not None:
+                return fingerprint
+        return self.dataset().fingerprint
+
+    def _shape(self) -> tuple[int, int, int, int]:
+        d1, d2 = self._input_datasets()
+        (n_rows, n_cols1), (_, n_cols2) = d1.shape, d2.shape
+        return n_rows, n_cols1, n_cols2, EarlyFusion.resolve_n_components(d1, d2, self.n_components)
+
+    def memory_footprint(self) -> int:
+        n_rows, _, _, n_components = self._shape()
+        return 2 * 4 * n_rows * 2 * n_components
+
+    def build_cost(self) -> float:
+        n_rows, n_cols1, n_cols2, n_components = self._shape()
+        search_cost = 2.0 * n_rows * n_rows * 2 * n_components
+        if getattr(datasets, self.name, None) is not None:
+            return search_cost
+        # Fitting and applying the PCA of both inputs
+        pca_cost = 4.0 * n_rows * (n_cols1 * n_cols1 + n_cols2 * n_cols2 + (n_cols1 + n_cols2) * n_components)
+        return pca_cost + search_cost
+
+
+@dataclass(frozen=True)
+class LateFusionSystem:
+    """Fusion of the result lists of other retrieval systems (see `late_fusion.fuse`)."""
+    name: str
+    system_names: tuple[str, ...]
+    weights: tuple[float, ...]
+    method: FusionMethod = "rank"
+
+    dataset_backed = False
+
+    @property
+    def inputs(self) -> tuple[str, ...]:
+        return self.system_names
+
+    def dataset(self) -> Optional[LocalDataset]:
+        return None
+
+    def build(self) -> None:
+        for name in self.system_names:
+            RETRIEVAL_SYSTEM_SPECS[name].build()
+
+    def fingerprint(self) -> str:
+        inputs = [RETRIEVAL_SYSTEM_SPECS[name].fingerprint() for name in self.system_names]
+        # Fused lists also change with the fusion code
+        return _hash(inputs, self.weights, self.method, code_version(late_fusion))
+
+    def memory_footprint(self) -> int:
+        return max(RETRIEVAL_SYSTEM_SPECS[name].memory_footprint() for name in self.system_names)
+
+    def build_cost(self) -> float:
+        # Fusing is negligible compared to the retrieval of the inputs
+        return sum(RETRIEVAL_SYSTEM_SPECS[name].build_cost() for name in self.system_names)
+
+
+@dataclass(frozen=True)
+class RandomSystem:
+    """Random baseline: n random songs per query."""
+    name: str
+
+    dataset_backed = False
+
+    @property
+    def inputs(self) -> tuple[str, ...]:
+        return ()
+
+    def dataset(self) -> Optional[LocalDataset]:
+        return None
+
+    def build(self) -> None:
+        pass
+
+    def fingerprint(self) -> str:
+        return _hash(self.name)
+
+    def memory_footprint(self) -> int:
+        return 0
+
+    def build_cost(self) -> float:
+        return 0.0
+
+
+RetrievalSystemSpec = Union[DatasetSystem, EarlyFusionSystem, LateFusionSystem, RandomSystem]
+
+
+def _registry(*specs: RetrievalSystemSpec) -> dict[str, RetrievalSystemSpec]:
+    return {spec.name: spec for spec in specs}
+
+
+RETRIEVAL_SYSTEM_SPECS: dict[str, RetrievalSystemSpec] = _registry(
+    RandomSystem("random_baseline"),
+
+    # lyrics
+    DatasetSystem("text_tf_idf", "tf_idf"),
+    DatasetSystem("text_bert", "lyrics_bert"),
+    DatasetSystem("text_word2vec", "word2vec"),
+
+    # audio
+    DatasetSystem("musicnn", "musicnn"),
+    DatasetSystem("mfcc_bow", "mfcc_bow"),
+    DatasetSystem("mfcc_stats", "mfcc_stats"),
+    DatasetSystem("ivec256", "ivec256"),
+    DatasetSystem("ivec512", "ivec512"),
+    DatasetSystem("ivec1024", "ivec1024"),
+    DatasetSystem("blf_correlation", "blf_correlation"),
+    DatasetSystem("blf_deltaspectral", "blf_deltaspectral"),
+    DatasetSystem("blf_logfluc", "blf_logfluc"),
+    DatasetSystem("blf_spectral", "blf_spectral"),
+    DatasetSystem("blf_spectralcontrast", "blf_spectralcontrast"),
+    DatasetSystem("blf_vardeltaspectral", "blf_vardeltaspectral"),
+
+    # video
+    DatasetSystem("video_resnet", "resnet"),
+    DatasetSystem("video_incp", "incp"),
+    DatasetSystem("video_vgg19", "vgg19"),
+
+    # fusion
+    EarlyFusionSystem("ef_bert_musicnn", ("lyrics_bert", "musicnn")),
+    EarlyFusionSystem("ef_bert_mfcc", ("lyrics_bert", "mfcc_bow")),
+    LateFusionSystem("lf_bert_mfcc_musicnn", ("ef_bert_mfcc", "video_resnet"), (0.5, 0.5), "rank"),
+)
+
+
+def get_spec(ret_sys_name: str) -> RetrievalSystemSpec:
+    spec = RETRIEVAL_SYSTEM_SPECS.get(ret_sys_name)
+    if spec is None:
+        raise ValueError(f"Unknown retrieval system '{ret_sys_name}'")
+    return spec
+
+
+def cheapest_first(ret_sys_names) -> list[str]:
+    """Orders retrieval systems by their estimated build cost (then memory footprint), cheapest first."""
+    return sorted(
+        ret_sys_names,
+        key=lambda name: (get_spec(name).build_cost(), get_spec(name).memory_footprint()),
+    )
+
+
+def build_all(ret_sys_names=None) -> None:
+    """Builds (and persists) the artifacts of the given (default: all) retrieval systems, cheapest first."""
+    for name in cheapest_first(ret_sys_names or RETRIEVAL_SYSTEM_SPECS):
+        print(f"Building retrieval system '{name}'")
+        get_spec(name).build()
+
+
+def system_report(ret_sys_names=None) -> pd.DataFrame:
+    """Memory footprint (in MiB) and estimated build cost (in GFLOP) of the given (default: all) systems."""
+    return pd.DataFrame([
+        {
+            "name": name,
+            "type": type(get_spec(name)).__name__,
+            "inputs": ", ".join(get_spec(name).inputs),
+            "memory_mib": get_spec(name).memory_footprint() / 1024 ** 2,
+            "build_gflop": np.round(get_spec(name).build_cost() / 1e9, 3),
+        }
+        for name in ret_sys_names or RETRIEVAL_SYSTEM_SPECS
+    ])
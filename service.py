@@ -0,0 +1,358 @@
+"""
+Local HTTP service for song recommendations on top of the `Retrieval` API.
+
+    python service.py [--host 127.0.0.1] [--port 8080] [--depth 100] [--window-ms 2]
+
+Routes (all GET, JSON responses):
+    /similar/{system}/{song_id}?n=10
+        Top-n songs of a retrieval system (see `retrieval_systems.RETRIEVAL_SYSTEM_SPECS`).
+    /fused/{song_id}?systems=a,b&weights=0.5,0.5&method=rank&n=10
+        Ad-hoc late fusion of any retrieval systems (see `late_fusion.fuse`).
+    /stats
+        Request counts and p50/p99 latencies per route, batch sizes per system.
+    /health
+"""
+import argparse
+import asyncio
+import json
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+from urllib.parse import parse_qs, unquote, urlsplit
+
+import numpy as np
+
+from late_fusion import fuse
+from retrieval import Retrieval
+from retrieval_systems import RETRIEVAL_SYSTEM_SPECS
+from song import songs
+
+# Requests that arrive within this time window (in seconds) are answered by one batch
+DEFAULT_BATCH_WINDOW = 0.002
+DEFAULT_MAX_BATCH_SIZE = 256
+
+# Number of recent requests the latency percentiles are computed from
+LATENCY_HISTORY = 10_000
+
+_STATUS_TEXT = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 500: "Internal Server Error"}
+
+
+class HttpError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+class LatencyStats:
+    """Latencies of the most recent requests per route."""
+
+    def __init__(self, history: int = LATENCY_HISTORY):
+        self._latencies: dict[str, deque] = {}
+        self._counts: dict[str, int] = {}
+        self._history = history
+
+    def record(self, route: str, seconds: float) -> None:
+        self._latencies.setdefault(route, deque(maxlen=self._history)).append(seconds)
+        self._counts[route] = self._counts.get(route, 0) + 1
+
+    def report(self) -> dict[str, dict[str, float]]:
+        report = {}
+        for route, latencies in self._latencies.items():
+            p50, p99 = np.percentile(np.fromiter(latencies, dtype=np.float64), [50, 99]) * 1000
+            report[route] = {"count": self._counts[route], "p50_ms": round(p50, 3), "p99_ms": round(p99, 3)}
+        return report
+
+
+class MicroBatcher:
+    """
+    Collects the queries of one retrieval system for up to `window` seconds (or until
+    `max_batch_size` are pending) and answers all of them with a single
+    `Retrieval.top_k_batch` call, which runs on the thread pool.
+    """
+
+    def __init__(
+            self,
+            retrieval: Retrieval,
+            ret_sys_name: str,
+            executor: ThreadPoolExecutor,
+            window: float = DEFAULT_BATCH_WINDOW,
+            max_batch_size: int = DEFAULT_MAX_BATCH_SIZE,
+    ):
+        self._ret = retrieval
+        self._ret_sys_name = ret_sys_name
+        self._executor = executor
+        self._window = window
+        self._max_batch_size = max_batch_size
+
+        self._pending: list[tuple[str, asyncio.Future]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+
+        self.n_batches = 0
+        self.n_queries = 0
+
+    def submit(self, song_id: str) -> asyncio.Future:
+        """Future of the (song rows, scores) of `song_id`, both of length `Retrieval.n`."""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((song_id, future))
+
+        if len(self._pending) >= self._max_batch_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self._window, self._flush)
+        return future
+
+    def _flush(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            asyncio.ensure_future(self._run(batch))
+
+    async def _run(self, batch: list[tuple[str, asyncio.Future]]) -> None:
+        # Requests for the same song share a row of the batch
+        query_ids = list(dict.fromkeys(song_id for song_id, _ in batch))
+        self.n_batches += 1
+        self.n_queries += len(query_ids)
+
+        loop = asyncio.get_running_loop()
+        try:
+            neighbours, scores = await loop.run_in_executor(
+                self._executor, self._ret.top_k_batch, self._ret_sys_name, query_ids
+            )
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        row_of = {song_id: i for i, song_id in enumerate(query_ids)}
+        for song_id, future in batch:
+            if not future.done():
+                future.set_result((neighbours[row_of[song_id]], scores[row_of[song_id]]))
+
+
+class RecommendationService:
+    def __init__(
+            self,
+            depth: int = 100,
+            window: float = DEFAULT_BATCH_WINDOW,
+            max_batch_size: int = DEFAULT_MAX_BATCH_SIZE,
+            threads: int = 4,
+    ):
+        self.depth = depth
+        self._ret = Retrieval(n=depth)
+        self._executor = ThreadPoolExecutor(max_workers=threads)
+        self._batchers = {
+            name: MicroBatcher(self._ret, name, self._executor, window, max_batch_size)
+            for name in RETRIEVAL_SYSTEM_SPECS
+        }
+        self.stats = LatencyStats()
+        self._song_ids: Optional[np.ndarray] = None
+
+    def _results(self, song_rows: np.ndarray, scores: np.ndarray, n: int) -> list[dict]:
+        if self._song_ids is None:
+            self._song_ids = songs.info["id"].to_numpy()
+        valid = song_rows[:n] >= 0
+        return [
+            {"id": song_id, "similarity": float(score)}
+            for song_id, score in zip(self._song_ids[song_rows[:n][valid]].tolist(), scores[:n][valid].tolist())
+        ]
+
+    def _check_song(self, song_id: str) -> None:
+        if songs.row_of(song_id) is None:
+            raise HttpError(404, f"Unknown song '{song_id}'")
+
+    def _batcher(self, ret_sys_name: str) -> MicroBatcher:
+        batcher = self._batchers.get(ret_sys_name)
+        if batcher is None:
+            raise HttpError(404, f"Unknown retrieval system '{ret_sys_name}'")
+        return batcher
+
+    def _parse_n(self, query: dict[str, list[str]]) -> int:
+        try:
+            n = int(query.get("n", ["10"])[0])
+        except ValueError:
+            raise HttpError(400, "Parameter 'n' must be an integer")
+        if not 1 <= n <= self.depth:
+            raise HttpError(400, f"Parameter 'n' must be between 1 and {self.depth}")
+        return n
+
+    async def similar(self, ret_sys_name: str, song_id: str, query: dict[str, list[str]]) -> dict:
+        n = self._parse_n(query)
+        batcher = self._batcher(ret_sys_name)
+        self._check_song(song_id)
+
+        song_rows, scores = await batcher.submit(song_id)
+        return {"system": ret_sys_name, "song_id": song_id, "results": self._results(song_rows, scores, n)}
+
+    async def fused(self, song_id: str, query: dict[str, list[str]]) -> dict:
+        n = self._parse_n(query)
+        systems = [name for name in ",".join(query.get("systems", [])).split(",") if name]
+        if not systems:
+            raise HttpError(400, "Parameter 'systems' is required")
+        try:
+            weights = [float(w) for w in query["weights"][0].split(",")] if "weights" in query \
+                else [1.0 / len(systems)] * len(systems)
+        except ValueError:
+            raise HttpError(400, "Parameter 'weights' must be a comma-separated list of numbers")
+        if len(weights) != len(systems):
+            raise HttpError(400, "Parameters 'systems' and 'weights' must have the same length")
+        method = query.get("method", ["rank"])[0]
+        if method not in ("score", "rank", "rrf", "combmnz"):
+            raise HttpError(400, "Parameter 'method' must be one of 'score', 'rank', 'rrf' or 'combmnz'")
+
+        batchers = [self._batcher(name) for name in systems]
+        self._check_song(song_id)
+
+        # Every input is batched with the concurrent requests for the same system
+        inputs = await asyncio.gather(*(batcher.submit(song_id) for batcher in batchers))
+        rows = [song_rows[song_rows >= 0] for song_rows, _ in inputs]
+        scores = [system_scores[song_rows >= 0] for song_rows, system_scores in inputs]
+        fused_rows, fused_scores = fuse(rows, scores, weights, method, k=n)
+
+        return {
+            "systems": systems,
+            "weights": weights,
+            "method": method,
+            "song_id": song_id,
+            "results": self._results(np.asarray(fused_rows), np.asarray(fused_scores), n),
+        }
+
+    def batch_report(self) -> dict[str, dict[str, float]]:
+        return {
+            name: {
+                "batches": batcher.n_batches,
+                "queries": batcher.n_queries,
+                "mean_batch_size": round(batcher.n_queries / batcher.n_batches, 2),
+            }
+            for name, batcher in self._batchers.items() if batcher.n_batches
+        }
+
+    async def dispatch(self, path: str) -> tuple[str, dict]:
+        """(route name, response) of a GET request for `path`."""
+        url = urlsplit(path)
+        parts = [unquote(part) for part in url.path.strip("/").split("/")]
+        query = parse_qs(url.query)
+
+        if len(parts) == 3 and parts[0] == "similar":
+            return "similar", await self.similar(parts[1], parts[2], query)
+        if len(parts) == 2 and parts[0] == "fused":
+            return "fused", await self.fused(parts[1], query)
+        if parts == ["stats"]:
+            return "stats", {"latency": self.stats.report(), "batches": self.batch_report()}
+        if parts == ["health"]:
+            return "health", {"status": "ok"}
+        raise HttpError(404, f"Unknown route '{url.path}'")
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        # HTTP/1.1 with keep-alive; requests on one connection are answered in order
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+
+                start = time.perf_counter()
+                # Malformed requests close the connection, since the next request cannot be found reliably
+                version = "HTTP/1.0"
+                try:
+                    try:
+                        method, path, request_version = request_line.decode("latin-1").split()
+                        content_length = int(headers.get("content-length", 0))
+                        if content_length < 0:
+                            raise ValueError(content_length)
+                    except ValueError:
+                        raise HttpError(400, "Malformed request")
+                    version = request_version
+                    if content_length:
+                        await reader.readexactly(content_length)
+
+                    if method != "GET":
+                        raise HttpError(405, f"Method '{method}' is not allowed")
+                    route, body = await self.dispatch(path)
+                    status = 200
+                except HttpError as e:
+                    route, status, body = "error", e.status, {"error": str(e)}
+                except (ConnectionError, asyncio.IncompleteReadError):
+                    raise
+                except Exception as e:
+                    route, status, body = "error", 500, {"error": f"{type(e).__name__}: {e}"}
+
+                keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+                payload = json.dumps(body).encode("utf-8")
+                writer.write(
+                    f"HTTP/1.1 {status} {_STATUS_TEXT[status]}\r\n"
+                    f"Content-Type: application/json\r\n"
+                    f"Content-Length: {len(payload)}\r\n"
+                    f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode("latin-1") + payload
+                )
+                await writer.drain()
+                self.stats.record(route, time.perf_counter() - start)
+
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    def warm_up(self) -> None:
+        """Loads the song table and opens the retrieval caches, so that the first requests are not slowed down."""
+        # Requests are served at any depth, queries beyond the cached one are computed on demand
+        shallow = {
+            name: depth for name in RETRIEVAL_SYSTEM_SPECS
+            if (depth := self._ret.cached_depth(name)) is not None and depth < self.depth
+        }
+
+        first_song = songs.info["id"].iat[0]
+        for name in RETRIEVAL_SYSTEM_SPECS:
+            self._ret.top_k_batch(name, [first_song])
+
+        if shallow:
+            name, depth = next(iter(shallow.items()))
+            print(
+                f"{len(shallow)} retrieval systems are cached with fewer than {self.depth} results per song "
+                f"(e.g. '{name}' with {depth}); deeper requests are computed on demand in batches"
+            )
+
+    async def serve(self, host: str, port: int) -> None:
+        server = await asyncio.start_server(self.handle_connection, host, port)
+        print(f"Serving recommendations on http://{host}:{port}")
+        async with server:
+            await server.serve_forever()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Local HTTP service for song recommendations")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--depth", type=int, default=100, help="Maximum n of a request")
+    parser.add_argument("--window-ms", type=float, default=DEFAULT_BATCH_WINDOW * 1000)
+    parser.add_argument("--max-batch-size", type=int, default=DEFAULT_MAX_BATCH_SIZE)
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--no-warm-up", action="store_true")
+    args = parser.parse_args()
+
+    service = RecommendationService(args.depth, args.window_ms / 1000, args.max_batch_size, args.threads)
+    if not args.no_warm_up:
+        print("Warming up retrieval caches")
+        service.warm_up()
+
+    try:
+        asyncio.run(service.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
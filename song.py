@@ -1,7 +1,12 @@
 from typing import Tuple, Optional
 from dataclasses import dataclass
 
+import numpy as np
+import pandas as pd
+
 from datasets import datasets
+from lazy import Lazy
+from song_search import SearchResult, SongSearchIndex
 
 
 @dataclass
@@ -10,15 +15,51 @@ class Song:
     artist: str
 
 
+def normalize_text(text: str) -> str:
+    # Case- and whitespace-insensitive form of titles and artist names
+    return " ".join(str(text).casefold().split())
+
+
 class SongTable:
     def __init__(self):
         self.info = datasets.information.df
 
+        # Hash indexes: song id -> row and normalized (title, artist) -> rows
+        self._id_to_row: dict[str, int] = {}
+        self._title_artist_to_rows: dict[tuple[str, str], list[int]] = {}
+
+        for row, (song_id, title, artist) in enumerate(zip(self.info["id"], self.info["song"], self.info["artist"])):
+            self._id_to_row.setdefault(song_id, row)
+            self._title_artist_to_rows.setdefault((normalize_text(title), normalize_text(artist)), []).append(row)
+
+        self._search_index: Optional[SongSearchIndex] = None
+
+    @property
+    def search_index(self) -> SongSearchIndex:
+        # Built once (and persisted) on first use
+        if self._search_index is None:
+            self._search_index = SongSearchIndex.load_or_build(self.info, datasets.information.tsv_path)
+        return self._search_index
+
+    def search(self, query: str, limit: int = 10) -> list[SearchResult]:
+        """Best matches for a partial or misspelled title and/or artist, e.g. for search-as-you-type."""
+        return self.search_index.search(query, limit)
+
+    def row_of(self, song_id: str) -> Optional[int]:
+        return self._id_to_row.get(song_id)
+
+    def rows_of(self, song_ids) -> np.ndarray:
+        """Rows of `song_ids` in the information table (-1 for unknown ids)."""
+        return np.fromiter((self._id_to_row.get(song_id, -1) for song_id in song_ids), dtype=np.intp, count=len(song_ids))
+
+    def take(self, song_ids) -> pd.DataFrame:
+        """Information rows of `song_ids` in the given order; unknown ids are skipped."""
+        rows = self.rows_of(song_ids)
+        return self.info.iloc[rows[rows >= 0]]
+
     def get_match(self, song: Song) -> Optional[Tuple[Song, int]]:
-        matches = self.info[
-            (self.info["song"] == song.title) &
-            (self.info["artist"] == song.artist)
-        ]
+        rows = self._title_artist_to_rows.get((normalize_text(song.title), normalize_text(song.artist)), [])
+        matches = self.info.iloc[rows]
 
         if len(matches) != 1:
             print("Query must match *exactly* 1 song, but matched the following song(s):")
@@ -41,7 +82,11 @@ class SongTable:
             if match is not None:
                 return match
             else:
+                print("Did you mean one of these?")
+                for result in self.search(f"{song_title} {artist_name}", limit=5):
+                    print(f"  - {result.song} by {result.artist}")
                 continue
 
 
-songs = SongTable()
+# The information table is parsed on first use
+songs: SongTable = Lazy(SongTable)
@@ -0,0 +1,135 @@
+import os
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+
+from utils import pickle_file, unpickle_file
+
+
+@dataclass
+class SearchResult:
+    id: str
+    song: str
+    artist: str
+    score: float
+
+
+def _normalize(text: str) -> str:
+    # Lowercase, replace punctuation by spaces and collapse whitespace
+    text = "".join(c if c.isalnum() else " " for c in str(text).casefold())
+    return " ".join(text.split())
+
+
+def _trigrams(text: str) -> set[str]:
+    # Words are padded, so that prefixes of words yield matching trigrams as well
+    trigrams = set()
+    for word in text.split():
+        padded = f"  {word} "
+        trigrams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return trigrams
+
+
+class SongSearchIndex:
+    """
+    Fuzzy search over song titles and artist names based on trigram posting lists.
+
+    Each song is indexed by the trigrams of its normalized "title artist" string.
+    A query is scored against every song sharing at least one trigram with it, by
+    the fraction of query trigrams it contains (which favours partial queries, e.g.
+    while typing) and the Dice coefficient of both trigram sets (which favours
+    closer matches). Typos only break a few trigrams, so misspelled queries still
+    rank the intended song highly.
+    """
+
+    def __init__(
+            self,
+            info: pd.DataFrame,
+            trigram_to_id: dict[str, int],
+            offsets: np.ndarray,
+            postings: np.ndarray,
+            n_trigrams: np.ndarray,
+            source_signature: Optional[tuple[int, int]] = None,
+    ):
+        self.ids = info["id"].to_numpy()
+        self.titles = info["song"].to_numpy()
+        self.artists = info["artist"].to_numpy()
+        self.normalized_titles = [_normalize(title) for title in self.titles]
+
+        self.trigram_to_id = trigram_to_id
+        self.offsets = offsets
+        self.postings = postings
+        self.n_trigrams = n_trigrams
+        self.source_signature = source_signature
+
+    @classmethod
+    def build(cls, info: pd.DataFrame, source_signature: Optional[tuple[int, int]] = None) -> "SongSearchIndex":
+        trigram_to_id: dict[str, int] = {}
+        doc_trigram_ids: list[list[int]] = []
+
+        for title, artist in zip(info["song"], info["artist"]):
+            trigrams = _trigrams(_normalize(f"{title} {artist}"))
+            doc_trigram_ids.append([trigram_to_id.setdefault(t, len(trigram_to_id)) for t in trigrams])
+
+        n_trigrams = np.array([len(t) for t in doc_trigram_ids], dtype=np.int32)
+        trigram_ids = np.fromiter((t for doc in doc_trigram_ids for t in doc), dtype=np.int32, count=n_trigrams.sum())
+        doc_rows = np.repeat(np.arange(len(doc_trigram_ids), dtype=np.int32), n_trigrams)
+
+        # CSR layout: the posting list of trigram t is postings[offsets[t]:offsets[t + 1]]
+        order = np.argsort(trigram_ids, kind="stable")
+        postings = doc_rows[order]
+        offsets = np.zeros(len(trigram_to_id) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(trigram_ids, minlength=len(trigram_to_id)), out=offsets[1:])
+
+        return cls(info, trigram_to_id, offsets, postings, n_trigrams, source_signature)
+
+    @classmethod
+    def load_or_build(cls, info: pd.DataFrame, source: Path) -> "SongSearchIndex":
+        """Loads the index from 'pickled_state/' or builds it if missing or built from an outdated `source`."""
+        os.makedirs("pickled_state", exist_ok=True)
+        path = "pickled_state/song_search_index.pickle"
+
+        stat = source.stat()
+        signature = (stat.st_size, stat.st_mtime_ns)
+
+        index = unpickle_file(path)
+        if index is None or index.source_signature != signature:
+            index = cls.build(info, signature)
+            pickle_file(path, index)
+        return index
+
+    def search(self, query: str, limit: int = 10) -> list[SearchResult]:
+        """Returns the `limit` best matching songs for a (partial or misspelled) query."""
+        normalized = _normalize(query)
+        query_trigrams = _trigrams(normalized)
+        query_trigram_ids = [self.trigram_to_id[t] for t in query_trigrams if t in self.trigram_to_id]
+        n_query_trigrams = len(query_trigrams)
+        if not query_trigram_ids:
+            return []
+
+        candidates = np.concatenate([
+            self.postings[self.offsets[t]:self.offsets[t + 1]] for t in query_trigram_ids
+        ])
+        shared = np.bincount(candidates, minlength=len(self.ids))
+        rows = np.flatnonzero(shared)
+        shared = shared[rows]
+
+        containment = shared / n_query_trigrams
+        dice = 2 * shared / (n_query_trigrams + self.n_trigrams[rows])
+        scores = 0.8 * containment + 0.2 * dice
+
+        # Songs whose title starts with the query are most likely what is being typed
+        is_prefix = np.fromiter(
+            (self.normalized_titles[row].startswith(normalized) for row in rows), dtype=bool, count=len(rows)
+        )
+        scores = scores + 0.1 * is_prefix
+
+        limit = min(limit, len(rows))
+        top = np.argpartition(-scores, limit - 1)[:limit]
+        top = top[np.argsort(-scores[top], kind="stable")]
+
+        return [
+            SearchResult(self.ids[rows[i]], self.titles[rows[i]], self.artists[rows[i]], float(scores[i])) for i in top
+        ]
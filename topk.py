@@ -0,0 +1,70 @@
+from typing import Iterator, Optional
+
+import numpy as np
+
+# Default memory budget (in bytes) for the similarity block of a single batch of queries
+DEFAULT_BLOCK_MEMORY_BUDGET = 256 * 1024 ** 2
+
+# float32 similarities + intp indices produced by argpartition for every block entry
+_BYTES_PER_BLOCK_ENTRY = np.dtype(np.float32).itemsize + np.dtype(np.intp).itemsize
+
+
+def top_n_indices(similarities: np.ndarray, n: int) -> np.ndarray:
+    """Indices of the ``n`` largest similarities, ordered from most to least similar."""
+    n = min(n, len(similarities) - 1)
+    if n <= 0:
+        return np.empty(0, dtype=np.intp)
+
+    candidates = np.argpartition(similarities, -n)[-n:]
+    return candidates[np.argsort(similarities[candidates])[::-1]]
+
+
+def block_size_for_budget(n_corpus: int, memory_budget: int) -> int:
+    return max(1, memory_budget // max(1, n_corpus * _BYTES_PER_BLOCK_ENTRY))
+
+
+def blocked_top_k(
+        features: np.ndarray,
+        k: int,
+        query_rows: Optional[np.ndarray] = None,
+        memory_budget: int = DEFAULT_BLOCK_MEMORY_BUDGET,
+        exclude_self: bool = True,
+) -> Iterator[tuple[np.ndarray, np.ndarray, np.ndarray]]:
+    """
+    Computes the top-k cosine neighbours of many queries at once.
+
+    ``features`` must hold L2-normalized rows (see :attr:`LocalDataset.matrix`).
+    Queries are processed in blocks whose (block x corpus) similarity matrix fits
+    into ``memory_budget`` bytes; each block is a single GEMM followed by a per-row
+    ``argpartition``.
+
+    :return: An iterator over ``(query_rows, neighbour_rows, similarities)`` per block,
+        where the latter two have shape (block, k) and are sorted by descending similarity.
+    """
+    n_corpus = features.shape[0]
+    if query_rows is None:
+        query_rows = np.arange(n_corpus)
+    query_rows = np.asarray(query_rows, dtype=np.intp)
+
+    k = min(k, n_corpus - 1 if exclude_self else n_corpus)
+    if k <= 0 or len(query_rows) == 0:
+        return
+
+    block_size = block_size_for_budget(n_corpus, memory_budget)
+
+    for start in range(0, len(query_rows), block_size):
+        rows = query_rows[start:start + block_size]
+        similarities = features[rows] @ features.T
+
+        if exclude_self:
+            # The query song itself should never be among its own neighbours
+            similarities[np.arange(len(rows)), rows] = -np.inf
+
+        candidates = np.argpartition(similarities, -k, axis=1)[:, -k:]
+        candidate_similarities = np.take_along_axis(similarities, candidates, axis=1)
+
+        order = np.argsort(-candidate_similarities, axis=1)
+        neighbours = np.take_along_axis(candidates, order, axis=1)
+        neighbour_similarities = np.take_along_axis(candidate_similarities, order, axis=1)
+
+        yield rows, neighbours, neighbour_similarities
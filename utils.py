@@ -1,11 +1,9 @@
 import json
 import os
 import pickle
-from typing import Tuple
+from typing import Tuple, Union
 
 import pandas as pd
-import matplotlib.pyplot as plt
-import matplotlib.patches as mpatches
 
 
 def read_tsv(file: str) -> pd.DataFrame:
@@ -110,6 +108,10 @@ def plot_ret_sys_dict(
         ylabel: str,
         filter: list[str],
 ) -> None:
+    # matplotlib is only needed for plotting, and slow to import
+    import matplotlib.pyplot as plt
+    import matplotlib.patches as mpatches
+
     # Extract retrieval system names and coverage values (filtered)
     sorted_dict = {k: v for k, v in sorted(ret_sys_dict.items(), key=lambda tup: tup[1], reverse=True) if k in filter}
 
@@ -204,12 +206,74 @@ def df_to_latex_table(df: pd.DataFrame) -> None:
     print("    \\bottomrule")
     print("  \\end{tabular}")
 
-def write_song_df_to_json_file(path: str, id_information: pd.DataFrame, id_url: pd.DataFrame, id_genres: pd.DataFrame) -> None:
-    songs = []
-    for index, row in id_information.iterrows():
-        ytId = id_url.loc[id_url['id'] == row['id']]['url'].values[0].split('=')[1]
-        genres = id_genres.loc[id_genres['id'] == row['id']]['genre'].values[0]
-        genres = json.loads(genres.replace("'", "\""))
-        songs.append({'id': row['id'], 'artist': row['artist'], 'song': row['song'], 'ytId': ytId, 'genres': genres})
-    with open(path, 'w') as outfile:
-        json.dump(songs, outfile)
+# The frontend's song list fetches the static 'songMeta.json' (see frontend/src/routes/+layout.ts); the song
+# pages read the shards of `frontend_export.export_frontend_shards` instead. 'retrievals/songMeta.json' is kept
+# next to the retrieval exports.
+SONG_META_JSON_PATHS = ["retrievals/songMeta.json", "frontend/static/songMeta.json"]
+
+
+def song_meta_df(id_information: pd.DataFrame, id_url: pd.DataFrame, id_genres: pd.DataFrame) -> pd.DataFrame:
+    """
+    Metadata (id, artist, song, ytId, genres) of every song in `id_information`, joined
+    once by id with the urls and genres. Songs without a url or genres get '' and [].
+    """
+    df = (
+        id_information[["id", "artist", "song"]]
+        .merge(id_url[["id", "url"]].drop_duplicates("id"), on="id", how="left")
+        .merge(id_genres[["id", "genre"]].drop_duplicates("id"), on="id", how="left")
+    )
+    df["ytId"] = df["url"].str.split("=", n=1).str[1].fillna("")
+
+    # Every distinct genre list is parsed once, in a single json.loads call
+    distinct = df["genre"].dropna().unique()
+    parsed = json.loads("[" + ",".join(genre.replace("'", "\"") for genre in distinct) + "]")
+    lookup = dict(zip(distinct, parsed))
+    df["genres"] = [lookup.get(genre, []) for genre in df["genre"]]
+    return df[["id", "artist", "song", "ytId", "genres"]]
+
+
+def write_song_df_to_json_file(
+        paths: Union[str, list[str]],
+        id_information: pd.DataFrame,
+        id_url: pd.DataFrame,
+        id_genres: pd.DataFrame,
+        ndjson: bool = False,
+        chunk_size: int = 10_000,
+) -> None:
+    """
+    Writes the song metadata (see `song_meta_df`) as a JSON array, or with `ndjson` as
+    one JSON object per line, to each of the given paths. The joined metadata is held in
+    memory as a whole; only its serialized output is built and written `chunk_size`
+    songs at a time, instead of as one string.
+    """
+    paths = [paths] if isinstance(paths, str) else paths
+    df = song_meta_df(id_information, id_url, id_genres)
+
+    outfiles = []
+    completed = False
+    try:
+        for path in paths:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            outfiles.append(open(f"{path}.tmp", "w"))
+
+        separator = "\n" if ndjson else ", "
+        for outfile in outfiles:
+            outfile.write("" if ndjson else "[")
+        for start in range(0, len(df), chunk_size):
+            records = df.iloc[start:start + chunk_size].to_dict("records")
+            chunk = ("" if start == 0 else separator) + separator.join(json.dumps(record) for record in records)
+            for outfile in outfiles:
+                outfile.write(chunk)
+        for outfile in outfiles:
+            outfile.write("\n" if ndjson and len(df) else "" if ndjson else "]")
+        completed = True
+    finally:
+        for outfile in outfiles:
+            outfile.close()
+            # Partially written files are not left behind
+            if not completed:
+                os.remove(outfile.name)
+
+    # Replaced only once complete, readers never see a partial file
+    for path in paths:
+        os.replace(f"{path}.tmp", path)
@@ -0,0 +1,219 @@
+import itertools
+from dataclasses import dataclass
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+
+from evaluation import Evaluation, NdcgMetric, PrecisionRecallMetric
+from genres import Genres
+from late_fusion import FusionMethod, ScoreNormalization, _grouped_average_rank, normalize_scores
+from progress import tqdm
+from retrieval import Retrieval
+
+
+@dataclass(frozen=True)
+class FusionConfig:
+    weights: tuple[float, ...]
+    method: FusionMethod = "rank"
+    normalization: ScoreNormalization = "none"
+
+
+def weight_grid(
+        n_systems: int,
+        steps: int = 11,
+        methods: tuple[FusionMethod, ...] = ("rank",),
+        normalizations: tuple[ScoreNormalization, ...] = ("none",),
+) -> list[FusionConfig]:
+    """All weight vectors on the simplex with a resolution of 1 / (steps - 1), for every method and normalization."""
+    resolution = steps - 1
+    weights = [
+        tuple(w / resolution for w in combination)
+        for combination in itertools.product(range(steps), repeat=n_systems)
+        if sum(combination) == resolution
+    ]
+    return [
+        FusionConfig(w, method, normalization)
+        for method, normalization, w in itertools.product(methods, normalizations, weights)
+    ]
+
+
+def random_weights(
+        n_systems: int,
+        n_configs: int,
+        methods: tuple[FusionMethod, ...] = ("rank",),
+        normalizations: tuple[ScoreNormalization, ...] = ("none",),
+        seed: int = 42,
+) -> list[FusionConfig]:
+    """`n_configs` weight vectors drawn uniformly from the simplex, with a random method and normalization each."""
+    rng = np.random.default_rng(seed)
+    return [
+        FusionConfig(
+            tuple(rng.dirichlet(np.ones(n_systems)).round(4).tolist()),
+            methods[rng.integers(len(methods))],
+            normalizations[rng.integers(len(normalizations))],
+        )
+        for _ in range(n_configs)
+    ]
+
+
+class _FusionCandidates:
+    """
+    The union of the result lists of all input systems per query, laid out as dense
+    (queries x union size) matrices sorted by song index. Everything that does not
+    depend on the weights (ranks, reciprocal ranks, hits, normalized scores) is computed
+    once, so that fusing with another configuration is a matrix-vector product and a sort.
+    Yields the same lists as `fuse_batch`.
+    """
+
+    def __init__(self, neighbours: list[np.ndarray], scores: list[np.ndarray], rrf_k: int = 60):
+        self._neighbours = neighbours
+        self._scores = scores
+        n_queries = neighbours[0].shape[0]
+
+        flat_query, flat_system, flat_id, flat_position = [], [], [], []
+        for system, system_neighbours in enumerate(neighbours):
+            query, position = np.nonzero(system_neighbours >= 0)
+            flat_query.append(query)
+            flat_system.append(np.full(len(query), system))
+            flat_id.append(system_neighbours[query, position].astype(np.int64))
+            flat_position.append(position)
+        self._flat_query = np.concatenate(flat_query)
+        self._flat_system = np.concatenate(flat_system)
+        self._flat_position = np.concatenate(flat_position)
+        flat_id = np.concatenate(flat_id)
+
+        n_ids = int(flat_id.max()) + 1 if len(flat_id) else 1
+        union_keys, self._union_index = np.unique(self._flat_query * n_ids + flat_id, return_inverse=True)
+        union_query, union_id = union_keys // n_ids, union_keys % n_ids
+
+        # Column of each union entry within its query's row (entries are sorted by query, then song)
+        counts = np.bincount(union_query, minlength=n_queries)
+        self._union_query = union_query
+        self._union_column = np.arange(len(union_keys)) - np.repeat(np.cumsum(counts) - counts, counts)
+        self._shape = (n_queries, int(counts.max(initial=0)))
+
+        self.ids = self._dense(union_id, -1)
+        self.valid = self.ids >= 0
+
+        self.hits = self._dense(np.bincount(self._union_index, minlength=len(union_keys)), 0)
+        self.reciprocal_ranks = self._per_system(1.0 / (rrf_k + self._flat_position + 1))
+        self._normalized_scores = {}
+        self._ranks = {}
+
+    def _dense(self, values: np.ndarray, fill) -> np.ndarray:
+        matrix = np.full(self._shape, fill, dtype=np.asarray(values).dtype)
+        matrix[self._union_query, self._union_column] = values
+        return matrix
+
+    def _per_system(self, flat_values: np.ndarray) -> np.ndarray:
+        matrix = np.zeros(self._shape + (len(self._neighbours),))
+        union_index = self._union_index
+        matrix[self._union_query[union_index], self._union_column[union_index], self._flat_system] = flat_values
+        return matrix
+
+    def _union_scores(self, normalization: ScoreNormalization) -> np.ndarray:
+        flat_scores = []
+        for system_neighbours, system_scores in zip(self._neighbours, self._scores):
+            system_scores = np.where(system_neighbours >= 0, system_scores.astype(np.float64), np.nan)
+            system_scores = normalize_scores(system_scores, normalization)
+            flat_scores.append(system_scores[system_neighbours >= 0])
+        flat_scores = np.nan_to_num(np.concatenate(flat_scores))
+
+        union_scores = np.zeros((len(self._union_query), len(self._neighbours)))
+        union_scores[self._union_index, self._flat_system] = flat_scores
+        return union_scores
+
+    def scores(self, normalization: ScoreNormalization) -> np.ndarray:
+        if normalization not in self._normalized_scores:
+            union_scores = self._union_scores(normalization)
+            self._normalized_scores[normalization] = np.stack([
+                self._dense(union_scores[:, system], 0.0) for system in range(len(self._neighbours))
+            ], axis=-1)
+        return self._normalized_scores[normalization]
+
+    def ranks(self, normalization: ScoreNormalization) -> np.ndarray:
+        if normalization not in self._ranks:
+            union_scores = self._union_scores(normalization)
+            self._ranks[normalization] = np.stack([
+                self._dense(_grouped_average_rank(self._union_query, union_scores[:, system]), 0.0)
+                for system in range(len(self._neighbours))
+            ], axis=-1)
+        return self._ranks[normalization]
+
+    def fuse(self, config: FusionConfig, k: int) -> np.ndarray:
+        """Top-k fused song indices (-1 padded) of every query."""
+        weights = np.asarray(config.weights, dtype=np.float64)
+
+        if config.method == "rank":
+            sort_key = self.ranks(config.normalization) @ weights
+        elif config.method == "score":
+            sort_key = -(self.scores(config.normalization) @ weights)
+        elif config.method == "combmnz":
+            sort_key = -(self.scores(config.normalization) @ weights) * self.hits
+        elif config.method == "rrf":
+            sort_key = -(self.reciprocal_ranks @ weights)
+        else:
+            raise ValueError("Invalid fusion method. Use 'score', 'rank', 'rrf' or 'combmnz'.")
+
+        # Columns are sorted by song index, so a stable sort breaks ties like `fuse_batch`
+        sort_key = np.where(self.valid, sort_key, np.inf)
+        top = np.argsort(sort_key, axis=1, kind="stable")[:, :k]
+        return np.take_along_axis(self.ids, top, axis=1)
+
+
+class WeightSweep:
+    """
+    Evaluates many late fusion configurations (weights, method, score normalization)
+    of a set of retrieval systems at once. The top-`depth` lists of the input systems
+    are read from the retrieval cache once; every configuration then fuses the lists of
+    the whole catalog in a single vectorized pass and is scored by precision, recall
+    and nDCG at `n`.
+    """
+
+    def __init__(
+            self,
+            genres: Genres,
+            ret_sys_names: list[str],
+            retrieval: Optional[Retrieval] = None,
+            depth: int = 100,
+            n: int = 10,
+    ):
+        self._genres = genres
+        self._ret_sys_names = ret_sys_names
+        self._ret = retrieval if retrieval else Retrieval(n=depth)
+        self._n = n
+
+        query_ids = genres.get_song_ids()
+        self._query_rows = np.arange(len(query_ids))
+        self._evaluation = Evaluation(genres, [PrecisionRecallMetric(n), NdcgMetric(n)], self._ret)
+
+        inputs = [self._ret.top_k_arrays(name, query_ids) for name in ret_sys_names]
+        self._candidates = _FusionCandidates(
+            [neighbours for neighbours, _ in inputs],
+            [scores for _, scores in inputs],
+        )
+
+    def evaluate(self, config: FusionConfig) -> dict[str, float]:
+        retrieved = self._candidates.fuse(config, self._n)
+        results = self._evaluation.finalize(self._evaluation.accumulate(retrieved, self._query_rows))
+
+        precision_at_k, recall_at_k = results["precision_recall"]
+        return {
+            f"precision@{self._n}": precision_at_k[self._n],
+            f"recall@{self._n}": recall_at_k[self._n],
+            f"ndcg@{self._n}": results["ndcg"],
+        }
+
+    def run(self, configs: list[FusionConfig]) -> pd.DataFrame:
+        """Evaluates all `configs`, best nDCG first."""
+        report = []
+        for config in tqdm(configs, desc=f"Sweeping fusion of {', '.join(self._ret_sys_names)}"):
+            report.append({
+                **{f"w_{name}": weight for name, weight in zip(self._ret_sys_names, config.weights)},
+                "method": config.method,
+                "normalization": config.normalization,
+                **self.evaluate(config),
+            })
+
+        return pd.DataFrame(report).sort_values(f"ndcg@{self._n}", ascending=False, ignore_index=True)